@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+import sys
+from queue import Queue, Empty
+from smtplib import SMTP, SMTPException, SMTPServerDisconnected
+from threading import Thread
+from time import monotonic, sleep
+
+SMTP_HOSTNAME = "localhost"
+SMTP_PORT = 25
+WINDOW = 60.0
+MIN_INTERVAL = 60.0
+DEDUPE_SECONDS = 3600.0
+IDLE_SECONDS = 30.0
+RETRIES = 3
+RETRY_DELAY = 2.0
+
+
+class AlertDispatcher:
+
+    def __init__(self, sender: str, recipient: str, subject: str, render=None, window: float = WINDOW,
+                 min_interval: float = MIN_INTERVAL, dedupe_seconds: float = DEDUPE_SECONDS,
+                 smtp_hostname: str = SMTP_HOSTNAME, smtp_port: int = SMTP_PORT, retries: int = RETRIES):
+
+        self.sender = sender
+        self.recipient = recipient
+        self.subject = subject
+        # Turns a batch of alert items into the message body; by default one line per item
+        self.render = render if render else lambda items: "\n".join(str(item) for item in items) + "\n"
+        self.window = window
+        self.min_interval = min_interval
+        self.dedupe_seconds = dedupe_seconds
+        self.smtp_hostname = smtp_hostname
+        self.smtp_port = smtp_port
+        self.retries = retries
+
+        self.queue = Queue()
+        self.pending = {}
+        self.sent = {}
+        self.smtp = None
+        self.last_used = None
+        self.last_sent = None
+        self.messages_sent = 0
+
+        # Delivery happens on a background thread, so probing never waits on the mail server
+        self.worker = Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def alert(self, key: str, item):
+
+        # Never blocks; the latest alert for a target within a window replaces any earlier one
+        self.queue.put((key, item))
+
+    def close(self):
+
+        # Sends whatever is still pending, without waiting out the window
+        self.queue.put(None)
+        self.worker.join()
+
+    def run(self):
+
+        deadline = None
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - monotonic(), 0)
+            elif self.smtp:
+                timeout = IDLE_SECONDS
+            try:
+                entry = self.queue.get(timeout=timeout)
+            except Empty:
+                entry = False
+
+            if entry is None:
+                break
+            try:
+                deadline = self.step(entry, deadline)
+            except Exception as e:
+                # Whatever went wrong costs at most the batch in hand; the worker keeps delivering later alerts
+                print(f"Alert dispatcher error: {e!r}", file=sys.stderr)
+
+        try:
+            self.send_pending()
+        except Exception as e:
+            print(f"Alert dispatcher error: {e!r}", file=sys.stderr)
+        self.disconnect()
+
+    def step(self, entry, deadline):
+
+        if entry:
+            key, item = entry
+            if not self.is_duplicate(key, item):
+                self.pending[key] = item
+                if deadline is None:
+                    # Coalesce for a window, and never send more often than min_interval
+                    deadline = monotonic() + self.window
+                    if self.last_sent is not None:
+                        deadline = max(deadline, self.last_sent + self.min_interval)
+
+        # Checked on every pass, so a steady stream of alerts can't hold a batch back past its deadline
+        if deadline is not None and monotonic() >= deadline:
+            deadline = None
+            if not self.send_pending():
+                # The mail server is down; try the same batch again after the usual wait
+                deadline = monotonic() + max(self.window, self.min_interval)
+        elif self.smtp and self.last_used is not None and monotonic() - self.last_used >= IDLE_SECONDS:
+            self.disconnect()
+        return deadline
+
+    def is_duplicate(self, key: str, item) -> bool:
+
+        # The same alert for the same target isn't sent again within dedupe_seconds
+        if key in self.pending:
+            return False
+        if (sent := self.sent.get(key)) and sent[1] == item and monotonic() - sent[0] < self.dedupe_seconds:
+            return True
+        return False
+
+    def send_pending(self) -> bool:
+
+        if not self.pending:
+            return True
+        items = self.pending
+        self.pending = {}
+        message = f"From: {self.sender}\nTo: {self.recipient}\nSubject: {self.subject}\n{self.render(list(items.values()))}"
+        if self.send(message):
+            now = monotonic()
+            # Forget alerts that are past dedupe_seconds, so a long-running daemon doesn't keep every key it ever saw
+            self.sent = {key: sent for key, sent in self.sent.items() if now - sent[0] < self.dedupe_seconds}
+            for key, item in items.items():
+                self.sent[key] = (now, item)
+        else:
+            # Keep the batch for the next attempt, behind any newer alert for the same target
+            self.pending = {**items, **self.pending}
+        self.last_sent = monotonic()
+        return not self.pending
+
+    def send(self, message: str) -> bool:
+
+        for attempt in range(self.retries):
+            try:
+                self.connect()
+                self.smtp.sendmail(self.sender, self.recipient, message)
+                self.last_used = monotonic()
+                self.messages_sent += 1
+                return True
+            except (SMTPException, OSError) as e:
+                self.disconnect()
+                if attempt == self.retries - 1:
+                    print(f"Alert not sent: {e}", file=sys.stderr)
+                    return False
+                sleep(RETRY_DELAY * 2 ** attempt)
+
+    def connect(self):
+
+        # The connection is kept open between messages, and only re-opened if the server dropped it
+        if self.smtp:
+            try:
+                self.smtp.noop()
+                return
+            except (SMTPServerDisconnected, OSError):
+                self.smtp = None
+        self.smtp = SMTP(self.smtp_hostname, port=self.smtp_port)
+        self.smtp.ehlo()
+
+    def disconnect(self):
+
+        if not self.smtp:
+            return
+        try:
+            self.smtp.quit()
+        except (SMTPException, OSError):
+            pass
+        self.smtp = None
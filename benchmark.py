@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+import sys
+from logging import getLogger, ERROR
+from argparse import ArgumentParser
+from asyncio import new_event_loop, run_coroutine_threadsafe, sleep, start_server, wait_for
+from json import dumps, loads
+from os import environ, wait4, waitstatus_to_exitcode, devnull
+from os.path import abspath, dirname, exists, join
+from socket import SOL_SOCKET, SO_LINGER
+from ssl import SSLContext, PROTOCOL_TLS_SERVER
+from struct import pack
+from subprocess import Popen, run, DEVNULL
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import time, perf_counter
+from timeout_policy import percentile
+
+SCRIPTS_DIR = dirname(abspath(__file__))
+RESULTS_FILE = "benchmark_results.jsonl"
+NUM_TARGETS = 2000
+CONCURRENCY = 200
+WORKERS = 1
+SLOW_SECONDS = 0.5
+REGRESSION_RATIO = 0.1
+FIRST_ADDRESS = 10
+
+# Each kind of stand-in server gets its own loopback address on port 443, weighted by how often it shows up in the target list
+KINDS = {
+    'ok': 70,
+    'slow_handshake': 5,
+    'slow_response': 5,
+    'error': 8,
+    'blackhole': 2,
+    'reset': 5,
+    'refused': 5,
+}
+
+CHECKERS = {
+    'site_checker': lambda files, args: ["site_checker.py", files['targets'], "--concurrency", str(args.concurrency), "--workers", str(args.workers), "--format", "ndjson"],
+    'check_site': lambda files, args: ["check_site.py", "--batch", files['urls'], "--workers", str(args.concurrency)],
+    'check_ssl_certs': lambda files, args: ["check_ssl_certs.py", files['targets']],
+    'check_ssl_certs2': lambda files, args: ["check_ssl_certs2.py", files['targets']],
+}
+
+
+def make_certs(cert_dir: str, addresses: list) -> dict:
+
+    # Throwaway CA plus one server cert for every stand-in address, made with the openssl CLI
+    files = {name: join(cert_dir, name) for name in ["ca.key", "ca.pem", "server.key", "server.csr", "server.pem", "server.ext"]}
+    with open(files['server.ext'], 'w') as f:
+        f.write("basicConstraints=CA:FALSE\n")
+        f.write("keyUsage=digitalSignature,keyEncipherment\n")
+        f.write("extendedKeyUsage=serverAuth\n")
+        f.write("authorityKeyIdentifier=keyid\n")
+        f.write("subjectAltName=DNS:localhost," + ",".join(f"IP:{address}" for address in addresses) + "\n")
+
+    commands = [
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "30", "-subj", "/CN=Benchmark CA",
+         "-addext", "basicConstraints=critical,CA:TRUE", "-addext", "keyUsage=critical,keyCertSign,cRLSign",
+         "-keyout", files['ca.key'], "-out", files['ca.pem']],
+        ["openssl", "req", "-newkey", "rsa:2048", "-nodes", "-subj", "/CN=localhost",
+         "-keyout", files['server.key'], "-out", files['server.csr']],
+        ["openssl", "x509", "-req", "-days", "30", "-in", files['server.csr'], "-CA", files['ca.pem'], "-CAkey", files['ca.key'],
+         "-CAcreateserial", "-extfile", files['server.ext'], "-out", files['server.pem']],
+    ]
+    for command in commands:
+        run(command, check=True, stdout=DEVNULL, stderr=DEVNULL)
+    return files
+
+
+class StandInServers:
+
+    def __init__(self, cert_files: dict, first_address: int = FIRST_ADDRESS):
+
+        self.ssl_context = SSLContext(PROTOCOL_TLS_SERVER)
+        self.ssl_context.load_cert_chain(cert_files['server.pem'], cert_files['server.key'])
+        self.addresses = {kind: f"127.0.0.{first_address + i}" for i, kind in enumerate(KINDS)}
+
+        # Seconds per request as seen from the server side: from accept (or the previous response) to the response,
+        # or from accept to close for connections that never got one
+        self.durations = []
+
+        # start_tls() on a stream server warns on every client EOF, which would drown out the report
+        getLogger("asyncio").setLevel(ERROR)
+
+        # Servers run on their own event loop in a thread, so they don't share the checker's CPU time accounting
+        self.loop = new_event_loop()
+        self.servers = []
+        Thread(target=self.loop.run_forever, daemon=True).start()
+        run_coroutine_threadsafe(self.start(), self.loop).result()
+
+    async def start(self):
+
+        for kind, address in self.addresses.items():
+            if kind != 'refused':
+                self.servers.append(await start_server(lambda r, w, kind=kind: self.handle(kind, r, w), address, 443, backlog=1024))
+
+    async def handle(self, kind: str, reader, writer):
+
+        started = mark = perf_counter()
+        served = False
+        try:
+            if kind == 'reset':
+                # Zero linger turns the close into a RST
+                writer.get_extra_info('socket').setsockopt(SOL_SOCKET, SO_LINGER, pack('ii', 1, 0))
+                writer.transport.abort()
+                return
+            if kind == 'blackhole':
+                # Accept the connection, then never answer; wait until the client gives up
+                while await reader.read(4096):
+                    pass
+                return
+            if kind == 'slow_handshake':
+                await sleep(SLOW_SECONDS)
+            await wait_for(writer.start_tls(self.ssl_context), 10)
+
+            status = "503 Service Unavailable" if kind == 'error' else "200 OK"
+            while (request := await reader.readuntil(b"\r\n\r\n")):
+                if kind == 'slow_response':
+                    await sleep(SLOW_SECONDS)
+                close = b"connection: close" in request.lower()
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Length: 2\r\n{'Connection: close' if close else ''}\r\n\r\nok".encode())
+                await writer.drain()
+                self.durations.append(perf_counter() - mark)
+                mark = perf_counter()
+                served = True
+                if close:
+                    break
+        except Exception:
+            pass
+        finally:
+            if not served:
+                self.durations.append(perf_counter() - started)
+            writer.close()
+
+    def write_targets(self, target_dir: str, num_targets: int) -> dict:
+
+        # Deterministic mix, so every run (and every checker) sees the same list
+        kinds = [kind for kind, weight in KINDS.items() for _ in range(weight)]
+        targets = [self.addresses[kinds[i % len(kinds)]] for i in range(num_targets)]
+        files = {'targets': join(target_dir, "targets.txt"), 'urls': join(target_dir, "urls.txt")}
+        with open(files['targets'], 'w') as f:
+            f.writelines(f"{target}\n" for target in targets)
+        with open(files['urls'], 'w') as f:
+            f.writelines(f"https://{target}/{i}\n" for i, target in enumerate(targets))
+        return files
+
+    def stop(self):
+
+        for server in self.servers:
+            server.close()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def run_checker(command: list, work_dir: str, ca_file: str) -> tuple:
+
+    # The checker runs as a child process, so wait4() can report its own peak RSS
+    env = {k: v for k, v in environ.items() if not k.lower().endswith("_proxy") and k.lower() != "proxy"}
+    env['SSL_CERT_FILE'] = ca_file
+    started = perf_counter()
+    with open(devnull, 'w') as null:
+        process = Popen([sys.executable] + command, cwd=work_dir, env=env, stdout=null, stderr=null)
+        _, status, usage = wait4(process.pid, 0)
+    process.returncode = waitstatus_to_exitcode(status)
+    return perf_counter() - started, usage.ru_maxrss / 1024, process.returncode
+
+
+def run_key(result: dict) -> tuple:
+
+    # Only runs with the same settings are comparable; older results predate --workers and ran with one
+    return result['checker'], result['targets'], result.get('concurrency'), result.get('workers', WORKERS)
+
+
+def load_previous(results_file: str, result: dict):
+
+    # The last successful run with the same settings; a checker that crashed part way says nothing about its speed
+    previous = None
+    if exists(results_file):
+        with open(results_file) as f:
+            for line in f:
+                _ = loads(line)
+                if run_key(_) == run_key(result) and not _.get('exit_status'):
+                    previous = _
+    return previous
+
+
+def compare(result: dict, previous: dict) -> str:
+
+    # Flags a drop in throughput or a rise in p95 latency of more than REGRESSION_RATIO
+    if result['exit_status']:
+        return f"FAILED (exit status {result['exit_status']})"
+    if not previous:
+        return "first run"
+    notes = []
+    change = result['targets_per_sec'] / previous['targets_per_sec'] - 1
+    notes.append(f"{change:+.0%} targets/sec")
+    if change < -REGRESSION_RATIO:
+        notes.append("REGRESSION")
+    if previous.get('p95_ms') and result.get('p95_ms'):
+        change = result['p95_ms'] / previous['p95_ms'] - 1
+        notes.append(f"{change:+.0%} p95")
+        if change > REGRESSION_RATIO:
+            notes.append("REGRESSION")
+    return ", ".join(dict.fromkeys(notes))
+
+
+def git_revision() -> str:
+
+    _ = run(["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPTS_DIR, capture_output=True, text=True)
+    return _.stdout.strip() if _.returncode == 0 else None
+
+
+def main():
+
+    from prettytable import PrettyTable
+
+    parser = ArgumentParser(description="Run the site checkers against local stand-in servers and report throughput")
+    parser.add_argument("--targets", type=int, default=NUM_TARGETS, help="number of synthetic targets")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="concurrency passed to checkers that support it")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="worker processes passed to checkers that support it")
+    parser.add_argument("--checkers", default=",".join(CHECKERS), help="comma-separated list of checkers to run")
+    parser.add_argument("--results", default=RESULTS_FILE, help="file that every run's results are appended to")
+    args = parser.parse_args()
+
+    revision = git_revision()
+    t = PrettyTable()
+    t.field_names = ["Checker", "Targets", "Seconds", "Targets/sec", "Peak RSS MB", "p50 ms", "p95 ms", "p99 ms", "vs. previous run"]
+
+    with TemporaryDirectory() as work_dir:
+        servers = None
+        try:
+            addresses = [f"127.0.0.{FIRST_ADDRESS + i}" for i in range(len(KINDS))]
+            cert_files = make_certs(work_dir, addresses)
+            try:
+                servers = StandInServers(cert_files)
+            except PermissionError:
+                sys.exit("Binding port 443 on loopback needs root or CAP_NET_BIND_SERVICE")
+            target_files = servers.write_targets(work_dir, args.targets)
+
+            for checker in args.checkers.split(","):
+                servers.durations = []
+                command = CHECKERS[checker](target_files, args)
+                command[0] = join(SCRIPTS_DIR, command[0])
+                seconds, peak_rss_mb, status = run_checker(command, work_dir, cert_files['ca.pem'])
+                durations = [d * 1000 for d in servers.durations]
+                result = {
+                    'timestamp': round(time()),
+                    'revision': revision,
+                    'checker': checker,
+                    'targets': args.targets,
+                    'concurrency': args.concurrency,
+                    'workers': args.workers,
+                    'seconds': round(seconds, 3),
+                    'targets_per_sec': round(args.targets / seconds, 1),
+                    'peak_rss_mb': round(peak_rss_mb, 1),
+                    'exit_status': status,
+                }
+                for p in [50, 95, 99]:
+                    result[f"p{p}_ms"] = round(percentile(durations, p), 1) if durations else None
+
+                previous = load_previous(args.results, result)
+                with open(args.results, 'a') as f:
+                    f.write(dumps(result) + "\n")
+                t.add_row([checker, args.targets, result['seconds'], result['targets_per_sec'], result['peak_rss_mb'],
+                           result['p50_ms'], result['p95_ms'], result['p99_ms'], compare(result, previous)])
+        finally:
+            if servers:
+                servers.stop()
+
+    print(t)
+    print("Latencies are per request as seen by the stand-in servers (accept to close for connections that got no response)")
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+from hashlib import sha256
+from time import mktime, strptime
+
+
+class CertInfo:
+
+    # Slots keep each entry small when a long-running daemon has seen thousands of certs
+    __slots__ = ('fingerprint', 'issued_timestamp', 'expiration_timestamp', 'not_after', 'common_name', 'sans', 'issuer')
+
+    def __init__(self, fingerprint: str, cert_details: dict, timestamps: tuple = None):
+
+        self.fingerprint = fingerprint
+        self.not_after = cert_details['notAfter']
+
+        # Get original issue and expiration timestamps, unless they're already known from a previous run
+        if timestamps:
+            self.issued_timestamp, self.expiration_timestamp = timestamps
+        else:
+            self.issued_timestamp = round(mktime(strptime(cert_details['notBefore'], "%b %d %H:%M:%S %Y %Z")))
+            self.expiration_timestamp = round(mktime(strptime(self.not_after, "%b %d %H:%M:%S %Y %Z")))
+
+        subject = dict(_[0] for _ in cert_details.get('subject', ()))
+        issuer = dict(_[0] for _ in cert_details.get('issuer', ()))
+        self.common_name = subject.get('commonName')
+        self.sans = tuple(value for key, value in cert_details.get('subjectAltName', ()) if key == 'DNS')
+        self.issuer = issuer.get('organizationName', issuer.get('commonName'))
+
+
+class CertCache:
+
+    def __init__(self, known_certs: dict = None):
+
+        # known_certs maps fingerprint -> (issued, expiration) timestamps saved by an earlier run
+        self.known_certs = known_certs if known_certs else {}
+        self.certs = {}
+
+    def get(self, der: bytes, cert_details: dict) -> CertInfo:
+
+        # Many hostnames share one wildcard/SAN cert, so each distinct cert is only parsed once
+        fingerprint = sha256(der).hexdigest()
+        if not (cert_info := self.certs.get(fingerprint)):
+            cert_info = CertInfo(fingerprint, cert_details, self.known_certs.get(fingerprint))
+            self.certs[fingerprint] = cert_info
+        return cert_info
+
+
+# Shared by everything in the process that doesn't bring its own cache
+CERT_CACHE = CertCache()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+from bisect import bisect_right
+from zlib import crc32
+from state_store import StateStore
+
+INDEX_FILE = "cert_index.json"
+STALE_DAYS = 21
+RECENT_DAYS = 1
+LOOKAHEAD_DAYS = 2
+DAY = 86400
+
+
+class CertIndex(StateStore):
+
+    def __init__(self, index_file: str = INDEX_FILE, stale_days: float = STALE_DAYS, recent_days: float = RECENT_DAYS,
+                 lookahead_days: float = LOOKAHEAD_DAYS):
+
+        # hostname -> {'fingerprint', 'expires', 'probed', 'changed'}, persisted the same way as check_sites' state
+        super().__init__(index_file)
+        self.stale_seconds = stale_days * DAY
+        self.recent_seconds = recent_days * DAY
+        self.lookahead_seconds = lookahead_days * DAY
+
+    def stale_at(self, hostname: str, record: dict) -> float:
+
+        # Certs first indexed in the same run would all go stale on the same day, so spread them over the window's last quarter
+        spread = crc32(hostname.encode()) / 0xFFFFFFFF / 4
+        return record['probed'] + self.stale_seconds * (1 - spread)
+
+    def due(self, hostnames: list, days_threshold: int, now: float) -> list:
+
+        # Hostnames never seen, or that failed last time, are always probed
+        records = {hostname: self.get(hostname) for hostname in hostnames}
+        known = [hostname for hostname, record in records.items() if record.get('expires')]
+        due = set(records) - set(known)
+
+        # Sorted by expiry: everything up to the alert threshold (plus some lookahead) is probed
+        by_expiry = sorted((records[hostname]['expires'], hostname) for hostname in known)
+        cutoff = bisect_right(by_expiry, (now + days_threshold * DAY + self.lookahead_seconds, chr(0x10FFFF)))
+        due.update(hostname for _, hostname in by_expiry[:cutoff])
+
+        # Sorted by when each record goes stale: anything not probed within the window is probed
+        by_stale = sorted((self.stale_at(hostname, records[hostname]), hostname) for hostname in known)
+        cutoff = bisect_right(by_stale, (now, chr(0x10FFFF)))
+        due.update(hostname for _, hostname in by_stale[:cutoff])
+
+        # Certs that changed recently get watched for a few runs, in case the new deployment is flapping
+        due.update(hostname for hostname in known
+                   if records[hostname].get('changed') is not None and records[hostname]['changed'] >= now - self.recent_seconds)
+
+        return [hostname for hostname in hostnames if hostname in due]
+
+    def record(self, hostname: str, now: float, fingerprint: str = None, expires: int = None):
+
+        previous = self.get(hostname)
+        changed = previous.get('changed')
+        if fingerprint and previous.get('fingerprint') and fingerprint != previous['fingerprint']:
+            changed = now
+        self.update(hostname, {
+            'fingerprint': fingerprint if fingerprint else previous.get('fingerprint'),
+            'expires': expires,
+            'probed': now,
+            'changed': changed,
+        })
@@ -1,100 +1,168 @@
 from os import environ
 from datetime import datetime, timezone
-from sys import argv, exit
-import csv
-from socket import create_connection
-from socks import socksocket, HTTP
+from time import perf_counter
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
 from urllib.parse import urlparse
-from ssl import create_default_context
-from time import mktime, strptime
-from itertools import chain
 from http.client import HTTPConnection, HTTPSConnection
+from result_sink import ResultSink
+from history_store import HistoryStore
+from tls_sessions import TLS_SESSIONS
 
 USER_AGENT = "Python http.client"
 TIMEOUT = 8
 CSV_FILE = "results.csv"
+WORKERS = 20
+PROXY_POOLS = {}
+PROXY_POOLS_LOCK = Lock()
+SINKS = {}
+SINKS_LOCK = Lock()
 
 
-def detect_proxy(protocol: str = None) -> dict:
+def detect_proxy(protocol: str = None) -> list:
 
-    if not (proxy := environ.get('proxy')):
-        proxy = environ.get('PROXY')
-    if not proxy:
-        for p in ["http", "https"]:
-            if not (proxy := environ.get(f"{p}_proxy")):
-                proxy = environ.get(f"{p.upper()}_PROXY")
+    # Protocol-specific setting first, then the generic one; a comma-separated value is a list of proxies
+    names = [f"{protocol}_proxy", f"{protocol.upper()}_PROXY"] if protocol else []
+    for name in names + ["proxy", "PROXY"]:
+        if proxy := environ.get(name):
+            break
+    else:
+        return []
 
-    if proxy:
-        _ = proxy[7:].split(":")
-        _ = {'host': str(_[0]), 'port': int(_[1])}
-        print("Proxy detected:", _)
-        return _
+    proxies = []
+    for _ in proxy.split(","):
+        _ = urlparse(_.strip() if "://" in _ else f"http://{_.strip()}")
+        proxies.append({'host': str(_.hostname), 'port': int(_.port if _.port else 8080)})
+    print("Proxy detected:", proxies)
+    return proxies
 
-    return {}
 
+class ProxyPool:
 
-def probe(host: str, port: int = 443, path: str = "/", scheme: str = "https") -> dict:
+    def __init__(self, proxies: list):
 
-    address = (str(host), int(port))
-    headers = {'Host': address[0], 'User-agent': USER_AGENT}
-    ssl_context = None
-    tls_info = None
+        self.proxies = proxies
+        self.in_use = [0] * len(proxies)
+        self.lock = Lock()
 
-    if proxy := detect_proxy(scheme):
-        if scheme == "https":
-            socket = socksocket()
-            print("Connecting to ", address, "using socket", socket)
-            socket.set_proxy(HTTP, proxy['host'], port=proxy['port'])
-            socket.connect(address)
-            socket.close()
-        #print(f"Proxy detected: {proxy['host']}:{proxy['port']}")
-        if scheme == "https":
-            conn = HTTPSConnection(proxy['host'], port=proxy['port'], timeout=TIMEOUT)
-            conn.set_tunnel(host, port=port)
-        else:
-            conn = HTTPConnection(proxy['host'], port=proxy['port'], timeout=TIMEOUT)
+    def acquire(self) -> dict:
+
+        # Least-loaded proxy gets the next origin, so no single proxy throttles the run
+        with self.lock:
+            index = min(range(len(self.proxies)), key=lambda i: self.in_use[i])
+            self.in_use[index] += 1
+        return self.proxies[index]
+
+    def release(self, proxy: dict):
+
+        with self.lock:
+            self.in_use[self.proxies.index(proxy)] -= 1
+
+
+def get_proxy_pool(scheme: str):
+
+    # Environment is only read once per scheme; None means connect directly
+    with PROXY_POOLS_LOCK:
+        if scheme not in PROXY_POOLS:
+            proxies = detect_proxy(scheme)
+            PROXY_POOLS[scheme] = ProxyPool(proxies) if proxies else None
+    return PROXY_POOLS[scheme]
+
+
+def connect(scheme: str, host: str, port: int, proxy: dict = None) -> HTTPConnection:
+
+    if proxy:
+        # HTTPS goes through one CONNECT tunnel that stays open for every request on the connection
+        match scheme:
+            case "http":
+                conn = HTTPConnection(proxy['host'], port=proxy['port'], timeout=TIMEOUT)
+            case "https":
+                conn = HTTPSConnection(proxy['host'], port=proxy['port'], timeout=TIMEOUT, context=TLS_SESSIONS.context)
+                conn.set_tunnel(host, port=port)
+            case _:
+                raise Exception(f"Unhandled scheme type: '{scheme}'")
     else:
-        socket = create_connection(address=address, timeout=TIMEOUT)
         #print("No proxy detected")
         match scheme:
             case "http":
                 conn = HTTPConnection(host, port=port, timeout=TIMEOUT)
             case "https":
-                ssl_context = create_default_context()
-                conn = HTTPSConnection(host, port=port, timeout=TIMEOUT, context=ssl_context)
-                ssl_socket = ssl_context.wrap_socket(socket, server_hostname=host)
-                tls_info = ssl_socket.version()
-                cert_details = ssl_socket.getpeercert()
-                print(cert_details)
-                cert_issued_timestamp = round(mktime(strptime(cert_details['notBefore'], "%b %d %H:%M:%S %Y %Z")))
-                cert_expiration_timestamp = round(mktime(strptime(cert_details['notAfter'], "%b %d %H:%M:%S %Y %Z")))
-                common_names = [_[1] for _ in list(chain(*cert_details['subject'])) if 'commonName' in _]
-                # print(tls_info, common_names[0], cert_expiration_timestamp)
+                # Shared context, so reconnects to the same IP and name resume the previous TLS session
+                conn = HTTPSConnection(host, port=port, timeout=TIMEOUT, context=TLS_SESSIONS.context)
             case _:
                 raise Exception(f"Unhandled scheme type: '{scheme}'")
 
-    print("path:", path)
-    conn.request(method="GET", url=path, headers=headers)
-    response = conn.getresponse()
-    conn.close()
+    conn.connect()
+    return conn
 
-    return {
-        'status': response.status,
-        'reason': response.reason,
-        'tls_info': tls_info,
-    }
+
+def probe_origin(scheme: str, host: str, port: int, paths: list) -> list:
+
+    # Every path on the origin goes over one keep-alive connection, so there's one TCP/TLS handshake instead of one per path
+    headers = {'Host': str(host), 'User-agent': USER_AGENT}
+    tls_info = None
+
+    proxy = pool.acquire() if (pool := get_proxy_pool(scheme)) else None
+    # Plain HTTP through a proxy needs the absolute URL in the request line
+    prefix = f"http://{host}:{port}" if proxy and scheme == "http" else ""
+
+    try:
+        started = perf_counter()
+        conn = connect(scheme, str(host), int(port), proxy)
+        # TCP connect plus TLS handshake (and CONNECT, through a proxy), shared by every path on the origin
+        connect_ms = round((perf_counter() - started) * 1000, 1)
+    except Exception as e:
+        if proxy:
+            pool.release(proxy)
+        return [{'status': "ERROR", 'reason': str(e), 'tls_info': tls_info} for _ in paths]
+
+    results = []
+    try:
+        if scheme == "https":
+            tls_info = conn.sock.version()
+        for path in paths:
+            try:
+                started = perf_counter()
+                conn.request(method="GET", url=prefix + path, headers=headers)
+                response = conn.getresponse()
+                ttfb_ms = round((perf_counter() - started) * 1000, 1)
+                # The body has to be read before the connection can carry the next request
+                response.read()
+                results.append({'status': response.status, 'reason': response.reason, 'tls_info': tls_info,
+                                'connect_ms': connect_ms, 'ttfb_ms': ttfb_ms})
+            except Exception as e:
+                # Drop the broken connection; http.client opens a fresh one on the next request
+                conn.close()
+                results.append({'status': "ERROR", 'reason': str(e), 'tls_info': tls_info, 'connect_ms': connect_ms})
+    finally:
+        conn.close()
+        if proxy:
+            pool.release(proxy)
+
+    return results
+
+
+def probe(host: str, port: int = 443, path: str = "/", scheme: str = "https") -> dict:
+
+    return probe_origin(scheme, host, port, [path])[0]
+
+
+def get_sink(csv_file: str = CSV_FILE) -> ResultSink:
+
+    # One buffered sink per file, shared by every probe thread; it flushes on its own and at exit
+    with SINKS_LOCK:
+        if csv_file not in SINKS:
+            SINKS[csv_file] = ResultSink(csv_file)
+        return SINKS[csv_file]
 
 
 def write_csv(data: list, csv_file: str = CSV_FILE):
 
-    fp = open(csv_file, 'a', newline='')
-    writer = csv.writer(fp)
-    #writer.writerow(data[0].keys())
-    _ = [writer.writerow(row.values()) for row in data]
-    fp.close()
+    get_sink(csv_file).write_rows(data)
 
 
-def main(url: str) -> dict:
+def parse_url(url: str) -> tuple:
 
     if not ("://" in url):
         if ":80/" in url or url.endswith(":80"):
@@ -114,11 +182,12 @@ def main(url: str) -> dict:
             case _:
                 port = 443
     path = _.path if _.path else "/"
-    timestamp = datetime.now(timezone.utc)
-    #print(f"Probing: {scheme}://{host}:{port}{path}")
-    result = probe(host, port, path, scheme)
-        
-    _ = {
+    return url, scheme, host, port, path
+
+
+def make_row(url: str, port: int, result: dict, timestamp: datetime) -> dict:
+
+    return {
         'timestamp': str(timestamp).split(".")[0],
         #'host': host,
         'url': url,
@@ -127,14 +196,74 @@ def main(url: str) -> dict:
         'reason': result.get('reason', "UNKNOWN"),
         'tls_info': result.get('tls_info', "UNKNOWN"),
     }
+
+
+def make_sample(url: str, result: dict, timestamp: datetime) -> tuple:
+
+    # One row for the history store: (url, timestamp, status, tls, connect_ms, ttfb_ms)
+    return (url, int(timestamp.timestamp()), str(result.get('status')), result.get('tls_info'),
+            result.get('connect_ms'), result.get('ttfb_ms'))
+
+
+def main(url: str, history: HistoryStore = None) -> dict:
+
+    url, scheme, host, port, path = parse_url(url)
+    timestamp = datetime.now(timezone.utc)
+    #print(f"Probing: {scheme}://{host}:{port}{path}")
+    result = probe(host, port, path, scheme)
+    _ = make_row(url, port, result, timestamp)
     write_csv([_])
+    if history:
+        history.add([make_sample(url, result, timestamp)])
     return _
 
 
+def main_batch(urls_file: str, workers: int = WORKERS, history: HistoryStore = None) -> list:
+
+    with open(urls_file) as fp:
+        urls = [line.strip() for line in fp if line.strip() and not line.startswith("#")]
+
+    # Group paths by origin, keeping each URL's position so rows come back in file order
+    origins = {}
+    for index, url in enumerate(urls):
+        url, scheme, host, port, path = parse_url(url)
+        origins.setdefault((scheme, host, port), []).append((index, url, path))
+
+    timestamp = datetime.now(timezone.utc)
+    rows = [None] * len(urls)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for (scheme, host, port), entries in origins.items():
+            future = executor.submit(probe_origin, scheme, host, port, [path for _, _, path in entries])
+            futures[future] = (port, entries)
+        for future in as_completed(futures):
+            port, entries = futures[future]
+            results = future.result()
+            for (index, url, _), result in zip(entries, results):
+                rows[index] = make_row(url, port, result, timestamp)
+            write_csv([rows[index] for index, _, _ in entries])
+            if history:
+                history.add([make_sample(url, result, timestamp) for (_, url, _), result in zip(entries, results)])
+
+    return rows
+
+
 if __name__ == "__main__":
 
-    if len(argv) < 2:
-        exit(f"Usage: {argv[0]} <target>")
-    _ = main(argv[1])
-    print(_)
+    parser = ArgumentParser()
+    parser.add_argument("target", help="URL to probe, or a file of URLs with --batch")
+    parser.add_argument("--batch", action="store_true", help="Probe every URL in the target file, one connection per origin")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="Origins to probe at once in batch mode")
+    parser.add_argument("--history", help="Also record results in this history database (see history_store.py)")
+    args = parser.parse_args()
 
+    history = HistoryStore(args.history) if args.history else None
+    if args.batch:
+        for _ in main_batch(args.target, args.workers, history):
+            print(_)
+    else:
+        _ = main(args.target, history)
+        print(_)
+    if history:
+        history.compact()
+        history.close()
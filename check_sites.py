@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
 DAYS_THRESHOLD = 30
+DEFAULT_INTERVAL = 900
+COLUMN_NAMES = ["Target", "IP Address", "TLS info", "HTTP Status", "Notes"]
 
 
 def BuildTable(column_names, rows):
@@ -16,7 +18,7 @@ def BuildTable(column_names, rows):
 
 class Target:
 
-    def __init__(self, target, port = 443):
+    def __init__(self, target, port = 443, ip_address = None, dns_ms = None, cert_cache = None, timeout_policy = None, resolved = False):
 
         if ":" in target:
             self.hostname, self.port = target.split(":")
@@ -24,8 +26,24 @@ class Target:
             self.hostname = target
             self.port = port
 
+        from timeout_policy import TimeoutPolicy
+
+        self.ip_address = ip_address
+        # Set when ip_address came from an earlier lookup, so None means the name doesn't resolve
+        self.resolved = resolved
+        self.policy = timeout_policy if timeout_policy else TimeoutPolicy()
+        self.cert_cache = cert_cache
+        self.key = f"{self.hostname}:{self.port}"
+
+        # Per-phase timings in milliseconds, None if the phase never ran
+        self.dns_ms = dns_ms
+        self.connect_ms = None
+        self.tls_ms = None
+        self.ttfb_ms = None
+
         self.is_resolvable = False
         self.is_reachable = False        
+        self.sock = None
         self.CheckReachability()
 
         self.tls_info = None
@@ -35,75 +53,123 @@ class Target:
         self.http_status = None
         self.CheckHTTP()
 
+        self.Close()
+
     def CheckReachability(self):
         
-        import socket
+        import socket, time
 
-        # Verify hostname resolves in DNS
-        try:
-            self.ip_address = socket.gethostbyname(self.hostname)
+        # Verify hostname resolves in DNS, unless the caller already resolved it
+        if self.ip_address:
             self.is_resolvable = True
-        except:
-            self.is_resolvable = False
-            self.ip_address = None
-
-        if self.is_resolvable:
-            # Verify hostname is reachable on port
+        elif not self.resolved:
             try:
-                self.sock = socket.create_connection((self.hostname, str(self.port)), timeout=1)
-                self.is_reachable = True
+                started = time.perf_counter()
+                self.ip_address = socket.gethostbyname(self.hostname)
+                self.dns_ms = round((time.perf_counter() - started) * 1000, 1)
+                self.is_resolvable = True
             except:
-                self.is_reachable = False
+                self.is_resolvable = False
+                self.ip_address = None
+
+        if self.is_resolvable:
+            # Verify hostname is reachable on port, connecting to the address resolved above
+            self.policy.retry_budget.attempt()
+            for attempt in range(2):
+                timeout = self.policy.timeout(self.key, 'connect')
+                try:
+                    started = time.perf_counter()
+                    self.sock = socket.create_connection((self.ip_address, str(self.port)), timeout=timeout)
+                    self.connect_ms = round((time.perf_counter() - started) * 1000, 1)
+                    self.policy.record(self.key, 'connect', self.connect_ms / 1000)
+                    self.is_reachable = True
+                    break
+                except socket.timeout:
+                    self.policy.record_timeout(self.key, 'connect', timeout)
+                    # A timeout gets one more try, if the run's retry budget allows it
+                    if attempt or not self.policy.retry_budget.try_retry():
+                        break
+                except:
+                    break
     
     def CheckSSL(self):
 
-        import ssl, time
+        import time
+        from cert_cache import CERT_CACHE
+        from tls_sessions import TLS_SESSIONS
 
+        self.cert_info = None
+        self.cert_fingerprint = None
         if self.is_reachable and self.port == 443:
             # Perform SSL/TLS handshake
             try:
-                self.ssl_context = ssl.create_default_context()
-                ssock = self.ssl_context.wrap_socket(self.sock, server_hostname=self.hostname)
+                # Shared context that resumes the last session with this IP and name; it's saved again when the socket closes
+                self.ssl_context = TLS_SESSIONS.context
+                timeout = self.policy.timeout(self.key, 'tls')
+                self.sock.settimeout(timeout)
+                started = time.perf_counter()
+                self.sock = self.ssl_context.wrap_socket(self.sock, server_hostname=self.hostname)
+                self.tls_ms = round((time.perf_counter() - started) * 1000, 1)
+                self.policy.record(self.key, 'tls', self.tls_ms / 1000)
+                ssock = self.sock
                 self.tls_info = ssock.version()
                 self.cert_details = ssock.getpeercert()
-                self.cert_issued_timestamp = round(time.mktime(time.strptime(self.cert_details['notBefore'], "%b %d %H:%M:%S %Y %Z")))
-                self.cert_expiration_timestamp = round(time.mktime(time.strptime(self.cert_details['notAfter'], "%b %d %H:%M:%S %Y %Z")))
-            except:
+                self.cert_info = (self.cert_cache if self.cert_cache else CERT_CACHE).get(ssock.getpeercert(True), self.cert_details)
+                self.cert_fingerprint = self.cert_info.fingerprint
+            except Exception as e:
+                if isinstance(e, TimeoutError):
+                    self.policy.record_timeout(self.key, 'tls', timeout)
                 self.tls_info = "ERROR"
                 self.cert_details = None
+                self.Close()
         else:
             self.tls_info = None
             self.cert_details = None
         
     def CheckHTTP(self):
 
-        import http.client
+        import http.client, time
     
-        if self.is_reachable:
+        if self.is_reachable and self.sock:
+            timeout = self.policy.timeout(self.key, 'http')
+            if self.port == 443:
+                conn = http.client.HTTPSConnection(self.hostname, self.port, timeout=timeout, context=self.ssl_context)
+            else:
+                conn = http.client.HTTPConnection(self.hostname, self.port, timeout=timeout)
+            # Send the request over the connection already opened (and TLS wrapped) for this target
+            self.sock.settimeout(timeout)
+            conn.sock = self.sock
             try:
-                if self.port == 443:
-                    conn = http.client.HTTPSConnection(self.hostname, self.port, timeout=1, context=self.ssl_context)
-                else:
-                    conn = http.client.HTTPConnection(self.hostname, self.port, timeout=1)
+                started = time.perf_counter()
                 conn.request(method="GET", url="/", headers={'User-agent':"Python http.client"})
                 resp = conn.getresponse()
+                self.ttfb_ms = round((time.perf_counter() - started) * 1000, 1)
+                self.policy.record(self.key, 'http', self.ttfb_ms / 1000)
                 self.http_status = str(resp.status)
                 if resp.reason:
                     self.http_status += ' ' + str(resp.reason)
+            except TimeoutError:
+                self.policy.record_timeout(self.key, 'http', timeout)
+                self.http_status = None
             except:
                 self.http_status = None
-            conn.close()
+    
+    def Close(self):
+
+        if self.sock:
+            self.sock.close()
+            self.sock = None
     
     def CalcSSLExpiration(self):
 
         import time, math
 
-        if self.tls_info and self.cert_details:
+        if self.tls_info and self.cert_info:
 
-            # Get original issue and expriation timestamps
-            self.issued_timestamp = round(time.mktime(time.strptime(self.cert_details['notBefore'], "%b %d %H:%M:%S %Y %Z")))
-            self.expiration_timestamp = round(time.mktime(time.strptime(self.cert_details['notAfter'], "%b %d %H:%M:%S %Y %Z")))
-            self.expiration_datetime = self.cert_details['notAfter']
+            # Get original issue and expriation timestamps, parsed once per distinct cert
+            self.issued_timestamp = self.cert_info.issued_timestamp
+            self.expiration_timestamp = self.cert_info.expiration_timestamp
+            self.expiration_datetime = self.cert_info.not_after
 
             # Adjust for local timezone setting
             local_timezone_offset = time.timezone if (time.localtime().tm_isdst == 0) else time.altzone
@@ -117,86 +183,301 @@ class Target:
             self.issued_timestamp = None
             self.expiration_timestamp = None
 
+def IterHostnames(input_file):
+
+    import sys
+
+    # Yields hostnames one at a time, so the list never has to be held in memory; '-' reads from stdin
+    if input_file == "-":
+        f = sys.stdin
+    else:
+        try:
+            f = open(input_file, 'r')
+        except:
+            sys.exit("Can't open file: '"+ input_file +"'")
+
+    for line in f:
+        if line.startswith('#') or not line.strip():
+            continue
+        else:
+            yield line.rstrip()
+    f.close()
+
+
 def ReadHostnamesList(input_file):
 
+    return list(IterHostnames(input_file))
+
+
+def ParseInterval(value):
+
+    # Accepts plain seconds or a number with an s/m/h suffix, e.g. "30", "30s", "15m", "1h"
+    units = {'s': 1, 'm': 60, 'h': 3600}
+    if value[-1].lower() in units:
+        return float(value[:-1]) * units[value[-1].lower()]
+    return float(value)
+
+
+def ReadTargetsList(input_file, default_interval = DEFAULT_INTERVAL):
+
     import sys
 
-    hostnames = []
+    # Same format as ReadHostnamesList, plus an optional probe interval after the hostname
+    targets = []
     try:
         f = open(input_file, 'r')
     except:
         sys.exit("Can't open file: '"+ input_file +"'")
 
     for line in f:
-        if line.startswith('#') or line.startswith('\n'):
+        if line.startswith('#') or not line.strip():
             continue
         else:
-            hostnames.append(line.rstrip())
+            fields = line.split()
+            interval = ParseInterval(fields[1]) if len(fields) > 1 else default_interval
+            targets.append((fields[0], interval))
     f.close()
-    return hostnames
+    return targets
 
 
-def main():
+def GetNotes(target):
+
+    notes = ""
+    if target.tls_info:
+        if target.tls_info == "ERROR":
+            notes += "SSL Handshake failure"
+        else:
+            if target.tls_info != "TLSv1.3" and target.tls_info != "TLSv1.2":
+                notes += "Does not support TLS 1.2 or 1.3"
+    if target.cert_details:
+        if target.days_until_expiration <= DAYS_THRESHOLD:
+            if target.days_until_expiration <= 2:
+                notes += f"Cert expires in {target.hours_until_expiration} hours!!!"
+            else:
+                notes += f"Cert expires in {target.days_until_expiration} days"
+    if target.http_status:
+        if 500 <= int(target.http_status[:3]) < 600:
+             notes += "HTTP 5xx response"
+    return notes
+
+
+def GetConditions(target):
+
+    # The problems behind the notes, without their countdown, so an expiring cert only counts as a change when it
+    # first comes within DAYS_THRESHOLD days and again when it's down to hours
+    conditions = []
+    if target.tls_info == "ERROR":
+        conditions.append("tls_error")
+    elif target.tls_info and target.tls_info != "TLSv1.3" and target.tls_info != "TLSv1.2":
+        conditions.append("old_tls")
+    if target.cert_details and target.days_until_expiration <= DAYS_THRESHOLD:
+        conditions.append("expires_hours" if target.days_until_expiration <= 2 else "expires_days")
+    if target.http_status and 500 <= int(target.http_status[:3]) < 600:
+        conditions.append("http_5xx")
+    return conditions
+
+
+def GetTransition(state, target, notes):
+
+    # Records the target's latest result and returns the notes to alert on, or None if nothing changed
+    conditions = GetConditions(target)
+    previous = state.update(target.hostname + ":" + str(target.port), {
+        'status': target.http_status,
+        'tls': target.tls_info,
+        'fingerprint': target.cert_fingerprint,
+        'issued': target.issued_timestamp,
+        'expires': target.expiration_timestamp,
+        'conditions': conditions,
+        'notes': notes,
+    })
+    # State saved before conditions were kept is compared on its notes, once
+    if 'conditions' in previous:
+        changed = conditions != previous['conditions']
+    else:
+        changed = notes != previous.get('notes', "")
+    if not changed:
+        return None
+    return notes if notes else "Resolved: " + previous['notes']
+
+
+def GetDispatcher(sender, recipient):
+
+    from alert_dispatcher import AlertDispatcher
+
+    # Alerts are queued per target and mailed in batches from a background thread, as one table per message
+    return AlertDispatcher(sender, recipient, "Site Issue", render=lambda rows: str(BuildTable(COLUMN_NAMES, rows)))
+
+
+async def RunDaemon(targets, concurrency, jitter, dispatcher = None, context = None, state = None, writer = None):
+
+    from time import monotonic
+    from probe_engine import probe_forever
 
-    import sys, socket, getpass, smtplib
+    last_saved = monotonic()
 
-    if len(sys.argv) < 2:
-        sys.exit("Usage: " + sys.argv[0] + " 'hostnames_file'")
-    input_file = sys.argv[1]
-    recipient = None
-    if len(sys.argv) > 2:
-        recipient = sys.argv[2]
-    if len(sys.argv) > 3:
-        sender = sys.argv[3]
+    # Each result goes through the same notes/alert logic as a one-shot run, as soon as it's available
+    async for target in probe_forever(targets, concurrency=concurrency, context=context, jitter=jitter):
+        notes = GetNotes(target)
+        row = [target.hostname + ":" + str(target.port), target.ip_address, target.tls_info, target.http_status, notes]
+        if writer:
+            writer.write(row)
+        if state:
+            notes = GetTransition(state, target, notes)
+            if monotonic() - last_saved > 60:
+                state.save()
+                last_saved = monotonic()
+        if not notes:
+            continue
+        if dispatcher:
+            dispatcher.alert(row[0], row[:-1] + [notes])
+        elif not writer:
+            print(BuildTable(COLUMN_NAMES, [row[:-1] + [notes]]), flush=True)
+
+
+def main():
+
+    import sys, socket, getpass, argparse
+
+    parser = argparse.ArgumentParser(usage=sys.argv[0] + " 'hostnames_file' [recipient] [sender]")
+    parser.add_argument("input_file", help="file with one hostname per line, or - to read from stdin")
+    parser.add_argument("recipient", nargs="?")
+    parser.add_argument("sender", nargs="?")
+    parser.add_argument("--concurrency", type=int, default=1, help="number of targets to probe at once")
+    parser.add_argument("--format", choices=["ndjson", "csv"], help="write each row to stdout as soon as its target finishes")
+    parser.add_argument("--table", action="store_true", help="with --format, also print the summary table (to stderr) at the end")
+    parser.add_argument("--timings", action="store_true", help="print p50/p95/p99 DNS, connect, TLS and time-to-first-byte latencies (to stderr) at the end")
+    parser.add_argument("--profile", metavar="PREFIX", help="write cProfile and tracemalloc data for the run to PREFIX.prof and PREFIX.mem.txt")
+    parser.add_argument("--timeout-history", metavar="FILE", help="file of per-target latencies to learn timeouts from, updated after each run")
+    parser.add_argument("--hedge", action="store_true", help="with --concurrency or --format, start a second connection when a handshake is slower than usual")
+    parser.add_argument("--daemon", action="store_true", help="keep running, re-probing each target on its interval")
+    parser.add_argument("--interval", type=ParseInterval, default=DEFAULT_INTERVAL, help="default probe interval in daemon mode, e.g. 30s or 15m")
+    parser.add_argument("--jitter", type=float, default=0.1, help="fraction of the interval to randomly vary each probe by")
+    parser.add_argument("--state", help="file to keep results in between runs, so alerts are only sent on changes")
+    args = parser.parse_args()
+
+    input_file = args.input_file
+    recipient = args.recipient
+    if args.sender:
+        sender = args.sender
     else:
         sender = getpass.getuser() + "@" + socket.getaddrinfo(socket.gethostname(), 0, flags=socket.AI_CANONNAME)[0][3]
 
-    hostnames = ReadHostnamesList(input_file)
+    state = None
+    if args.state:
+        from state_store import StateStore
+        state = StateStore(args.state)
+    # Certs seen on earlier runs (same fingerprint) don't need their dates parsed again
+    from cert_cache import CertCache
+    cert_cache = CertCache(state.known_certs() if state else None)
+
+    # Timeouts are learned from each target's latency history, kept between runs in --timeout-history
+    from timeout_policy import TimeoutPolicy
+    from probe_engine import ProbeContext
+    policy = TimeoutPolicy()
+    if args.timeout_history:
+        policy.load(args.timeout_history)
+    context = ProbeContext(cert_cache=cert_cache, policy=policy, hedge=args.hedge)
+
+    if args.profile:
+        from probe_stats import RunProfiler
+        RunProfiler(args.profile)
+
+    timings = None
+    if args.timings:
+        from probe_stats import PhaseTimings
+        timings = PhaseTimings()
+
+    writer = None
+    if args.format:
+        from row_writer import RowWriter
+        writer = RowWriter(args.format, COLUMN_NAMES)
+
+    dispatcher = GetDispatcher(sender, recipient) if recipient else None
+
+    if args.daemon:
+        from asyncio import run
+        targets = ReadTargetsList(input_file, args.interval)
+        try:
+            run(RunDaemon(targets, max(args.concurrency, 1), args.jitter, dispatcher, context, state, writer))
+        except KeyboardInterrupt:
+            pass
+        if dispatcher:
+            dispatcher.close()
+        if state:
+            state.save()
+        if args.timeout_history:
+            policy.save(args.timeout_history)
+        return
+
+    if args.format:
+        # Read targets lazily and write each row as its target finishes, holding only the rows still needed
+        from probe_engine import iterate, probe_targets
+        targets = iterate(probe_targets(IterHostnames(input_file), concurrency=max(args.concurrency, 1), context=context))
+    elif args.concurrency > 1:
+        # Probe many targets at once, so the run takes as long as the slowest target
+        from asyncio import run
+        from probe_engine import probe_all
+        hostnames = ReadHostnamesList(input_file)
+        targets = run(probe_all(hostnames, concurrency=args.concurrency, context=context))
+    else:
+        # Resolve every name up front through the shared cache, then probe one target at a time
+        from dns_cache import CachingResolver, resolve_all
+        hostnames = ReadHostnamesList(input_file)
+        resolver = CachingResolver()
+        addresses = resolve_all((hostname.split(":")[0] for hostname in hostnames), resolver)
+        targets = (Target(hostname, ip_address=addresses[hostname.split(":")[0]], dns_ms=resolver.lookup_ms.get(hostname.split(":")[0]), cert_cache=cert_cache, timeout_policy=policy, resolved=True) for hostname in hostnames)
 
     output = ""
     results = []
-    for hostname in hostnames:
-
-        target = Target(hostname)
+    changes = []
+    for target in targets:
         #print(target.hostname, target.port, target.tls_info, target.http_status)
-        notes = ""
-        if target.tls_info:
-            if target.tls_info == "ERROR":
-                notes += "SSL Handshake failure"
-            else:
-                if target.tls_info != "TLSv1.3" and target.tls_info != "TLSv1.2":
-                    notes += "Does not support TLS 1.2 or 1.3"
-        if target.cert_details:
-            if target.days_until_expiration <= DAYS_THRESHOLD:
-                if target.days_until_expiration <= 2:
-                    notes += f"Cert expires in {target.hours_until_expiration} hours!!!"
-                else:
-                    notes += f"Cert expires in {target.days_until_expiration} days"
-        if target.http_status:
-            if 500 <= int(target.http_status[:3]) < 600:
-                 notes += "HTTP 5xx response"
-        results.append([target.hostname + ":" + str(target.port), target.ip_address, target.tls_info, target.http_status, notes])
-
-    output = BuildTable(["Target", "IP Address", "TLS info", "HTTP Status", "Notes"], results)
-
-    if recipient and notes:
-        subject = "Site Issue"
-        message = f"From: {sender}\nTo: {recipient}\nSubject: {subject}\n{output}"
-        try:
-            server = smtplib.SMTP('localhost', port=25)
-            server.ehlo()
-            server.sendmail(sender, recipient, message)
-            server.quit()
-        except Exception as e:
-            print(e)
-    else:
+        notes = GetNotes(target)
+        if timings:
+            timings.add(target)
+        row = [target.hostname + ":" + str(target.port), target.ip_address, target.tls_info, target.http_status, notes]
+        if writer:
+            writer.write(row)
+        if not writer or args.table or notes:
+            results.append(row)
+        if state and (change := GetTransition(state, target, notes)):
+            changes.append(row[:-1] + [change])
+
+    output = BuildTable(COLUMN_NAMES, results)
+
+    if args.timeout_history:
+        policy.save(args.timeout_history)
+
+    if state:
+        state.save()
+        # Only alert on targets whose notes changed since the previous run
+        if recipient:
+            for row in changes:
+                dispatcher.alert(row[0], row)
+        elif not writer:
+            print(output)
+    elif recipient and any(row[-1] for row in results):
+        for row in results:
+            dispatcher.alert(row[0], row)
+    elif not writer:
         print(output)
 
+    # Sends anything still queued right away, rather than waiting out the coalescing window
+    if dispatcher:
+        dispatcher.close()
+
+    if writer and args.table:
+        print(output, file=sys.stderr)
+
+    if timings:
+        print(BuildTable(timings.summary_columns(), timings.summary_rows()), file=sys.stderr)
+
 if __name__ == "__main__":
 
+    import sys
     from time import time
 
     start_time: time = time()
     main()
-    print("seconds_to_execute:", round((time() - start_time), 3))
+    print("seconds_to_execute:", round((time() - start_time), 3), file=sys.stderr)
 
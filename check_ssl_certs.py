@@ -3,15 +3,24 @@
 # Just in case still running on Python2
 from __future__ import print_function
 
-from smtplib import SMTP
 from sys import exit, argv
 from getpass import getuser
-from socket import create_connection, gethostname, gethostbyname, getaddrinfo, getaddrinfo, AI_CANONNAME
-from ssl import create_default_context
+from socket import create_connection, gethostname, gethostbyname, getaddrinfo, getaddrinfo, AI_CANONNAME, timeout as SocketTimeout
 from math import ceil
-from time import time, localtime, timezone, altzone, mktime, strptime
+from select import select
+from time import time, localtime, timezone, altzone, perf_counter
+from argparse import ArgumentParser
+from alert_dispatcher import AlertDispatcher
+from concurrent.futures import ThreadPoolExecutor
+from cert_cache import CERT_CACHE
+from cert_index import CertIndex, INDEX_FILE, STALE_DAYS
+from dns_cache import resolve_all
+from scan_planner import IPBudget, PER_IP, group_by_ip, group_certs, interleave
+from timeout_policy import TimeoutPolicy
+from tls_sessions import TLS_SESSIONS
 
 DAYS_THRESHOLD = 12
+TICKET_WAIT = 0.2
 INPUT_FILE = "cert_hostnames.txt"
 
 
@@ -45,19 +54,25 @@ class Target:
 
 class SSLCert:
 
-    def __init__(self, hostname):
+    def __init__(self, hostname, ip_address=None, timeout_policy=None, resolved=False):
 
         self.hostname = hostname
         self.common_name = hostname
+        self.ip_address = ip_address
+        # Set when ip_address came from an earlier lookup, so None means the name doesn't resolve
+        self.resolved = resolved
+        self.policy = timeout_policy if timeout_policy else TimeoutPolicy()
 
         # Retrieve details for the certificate
         self.is_valid, self.details = self.GetCertDetails()
         if not self.is_valid:
             return None
 
-        # Get original issue and expriation timestamps
-        self.issued_timestamp = round(mktime(strptime(self.details['notBefore'], "%b %d %H:%M:%S %Y %Z")));
-        self.expiration_timestamp = round(mktime(strptime(self.details['notAfter'], "%b %d %H:%M:%S %Y %Z")));
+        # Get original issue and expriation timestamps, parsed once per distinct cert
+        cert_info = CERT_CACHE.get(self.der, self.details)
+        self.fingerprint = cert_info.fingerprint
+        self.issued_timestamp = cert_info.issued_timestamp
+        self.expiration_timestamp = cert_info.expiration_timestamp
 
         # Adjust for local timezone setting
         local_timezone_offset = timezone if localtime().tm_isdst == 0 else altzone
@@ -71,31 +86,70 @@ class SSLCert:
 
     def GetCertDetails(self):
 
-        context = create_default_context()
-
-        # Verify hostname is resolvable
-        try:
-            gethostbyname(self.hostname)
-        except:
-            return False, "does not resolve in DNS"
-
-        # Verify hostname is reachable on port 443
-        try:
-            sock = create_connection((self.hostname, "443"), timeout=2)
-        except:
-            return False, "is not reachable on port 443"
+        # Shared context that offers the session saved from the last handshake with this IP and name
+        context = TLS_SESSIONS.context
+
+        # Verify hostname is resolvable, unless the caller already resolved it
+        if not self.ip_address:
+            if self.resolved:
+                return False, "does not resolve in DNS"
+            try:
+                self.ip_address = gethostbyname(self.hostname)
+            except:
+                return False, "does not resolve in DNS"
+
+        # Verify hostname is reachable on port 443, connecting to the address resolved above
+        key = f"{self.hostname}:443"
+        self.policy.retry_budget.attempt()
+        for attempt in range(2):
+            timeout = self.policy.timeout(key, 'connect')
+            try:
+                started = perf_counter()
+                sock = create_connection((self.ip_address, "443"), timeout=timeout)
+                self.policy.record(key, 'connect', perf_counter() - started)
+                break
+            except SocketTimeout:
+                self.policy.record_timeout(key, 'connect', timeout)
+                # A timeout gets one more try, if the run's retry budget allows it
+                if attempt or not self.policy.retry_budget.try_retry():
+                    return False, "is not reachable on port 443"
+            except:
+                return False, "is not reachable on port 443"
 
         # Attempt SSL connection
+        timeout = self.policy.timeout(key, 'tls')
+        ssock = None
         try:
+            sock.settimeout(timeout)
+            started = perf_counter()
             ssock = context.wrap_socket(sock, server_hostname = self.hostname)
+            self.policy.record(key, 'tls', perf_counter() - started)
+        except SocketTimeout:
+            self.policy.record_timeout(key, 'tls', timeout)
+            return False, "SSL handshake timed out"
         except:
             return False, "SSL handshake failed - hostname mismatch, bad chain, or expired certificate?"
+        finally:
+            if not ssock:
+                sock.close()
 
         # Attempt to get certificate details
         try:
             cert_details = ssock.getpeercert()
+            self.der = ssock.getpeercert(True)
+            # TLS 1.3 session tickets come after the handshake, and are only processed when the socket is read;
+            # without them there's no session to resume next time
+            if ssock.version() == "TLSv1.3":
+                ssock.setblocking(False)
+                if select([ssock], [], [], TICKET_WAIT)[0]:
+                    try:
+                        ssock.recv(1)
+                    except OSError:
+                        pass
         except:
             return False, "Cannot get certificate details"
+        finally:
+            ssock.close()
 
         # Cert looks good
         return True, cert_details
@@ -120,47 +174,79 @@ def get_targets(input_file: str) -> list:
 
 def main():
 
-    if len(argv) < 2:
-        exit("Usage: " + argv[0] + " 'hostnames_file'")
-    input_file = argv[1]
-    recipient = None
-    if len(argv) > 2:
-        recipient = argv[2]
-    if len(argv) > 3:
-        sender = argv[3]
+    parser = ArgumentParser(usage=argv[0] + " 'hostnames_file' [recipient] [sender]")
+    parser.add_argument("input_file", nargs="?", default=INPUT_FILE)
+    parser.add_argument("recipient", nargs="?")
+    parser.add_argument("sender", nargs="?")
+    parser.add_argument("--full", action="store_true", help="probe every hostname, not just the ones the index says are due")
+    parser.add_argument("--index", default=INDEX_FILE, help="file of known certs, updated after each run")
+    parser.add_argument("--stale-days", type=float, default=STALE_DAYS, help="re-probe any cert not checked within this many days")
+    parser.add_argument("--workers", type=int, default=1, help="number of handshakes to run at once")
+    parser.add_argument("--per-ip", type=int, default=PER_IP, help="with --workers, at most this many handshakes to any one IP at once")
+    args = parser.parse_args()
+
+    input_file = args.input_file
+    recipient = args.recipient
+    if args.sender:
+        sender = args.sender
     else:
         sender = getuser() + "@" + getaddrinfo(gethostname(), 0, flags=AI_CANONNAME)[0][3]
 
+    # Same local-offset clock the expiration timestamps are kept in
+    local_timezone_offset = timezone if localtime().tm_isdst == 0 else altzone
+    current_timestamp = round(time()) + local_timezone_offset
+
+    # Only probe certs that are near expiry, changed recently, failed last time, or haven't been checked in a while
+    index = CertIndex(args.index, stale_days=args.stale_days)
     hostnames = get_targets(input_file)
+    if not args.full:
+        hostnames = index.due(hostnames, DAYS_THRESHOLD, current_timestamp)
+    addresses = resolve_all(hostnames)
+    policy = TimeoutPolicy()
+
+    # Names behind the same front end are spread through the run, and each IP gets a small connection budget
+    hostnames = interleave(group_by_ip(hostnames, addresses))
+    budget = IPBudget(args.per_ip)
+
+    def check(hostname):
+        with budget.semaphore(addresses[hostname]):
+            return SSLCert(hostname, addresses[hostname], policy, resolved=True)
 
-    output = ""
-    for hostname in hostnames:
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        certs = list(executor.map(check, hostnames))
 
-        cert = SSLCert(hostname)
+    alerts = []
+    expiring = []
+    for cert in certs:
 
         if not cert.is_valid:
-            output += "Problem for " + hostname + ": " + cert.details + "\n"
+            index.record(cert.hostname, current_timestamp)
+            alerts.append((cert.hostname, "Problem for " + cert.hostname + ": " + cert.details))
             continue
+        index.record(cert.hostname, current_timestamp, cert.fingerprint, cert.expiration_timestamp)
 
         if cert.days_until_expiration <= DAYS_THRESHOLD:
-            output += cert.hostname + " will expire in "
-            if cert.days_until_expiration <= 1:
-                output += str(cert.hours_until_expiration) + " hours!!!\n"
-            else:
-                output += str(cert.days_until_expiration) + " days\n"
-
-    if recipient and output:
-        subject = "An SSL certificate is expiring soon!"
-        message = f"From: {sender}\nTo: {recipient}\nSubject: {subject}\n{output}"
-        try:
-            server = SMTP('localhost', port=25)
-            server.ehlo()
-            server.sendmail(sender, recipient, message)
-            server.quit()
-        except Exception as e:
-            print(e)
+            expiring.append(cert)
+
+    # Each expiring cert is reported once, with every name it was seen on
+    for fingerprint, group in group_certs((cert, cert.fingerprint) for cert in expiring).items():
+        cert = group[0]
+        line = ", ".join(_.hostname for _ in group) + " will expire in "
+        if cert.days_until_expiration <= 1:
+            line += str(cert.hours_until_expiration) + " hours!!!"
+        else:
+            line += str(cert.days_until_expiration) + " days"
+        alerts.append((fingerprint, line))
+
+    if recipient and alerts:
+        dispatcher = AlertDispatcher(sender, recipient, "An SSL certificate is expiring soon!")
+        for key, line in alerts:
+            dispatcher.alert(key, line)
+        dispatcher.close()
     else:
-        print(output, end="")
+        print("".join(line + "\n" for _, line in alerts), end="")
+
+    index.save()
 
 
 if __name__ == "__main__":
@@ -1,18 +1,18 @@
 #!/usr/bin/env python
 
-from asyncio import gather, run, new_event_loop, open_connection, get_event_loop
-from smtplib import SMTP
-from time import time, mktime, strptime, localtime, timezone, altzone
+from asyncio import TimeoutError, gather, get_running_loop, run, open_connection, wait_for
+from time import time, localtime, timezone, altzone, perf_counter
 from math import ceil
-from ssl import create_default_context, SSLContext, PROTOCOL_TLS, PROTOCOL_TLS_CLIENT, PROTOCOL_TLSv1_2
-from socket import gethostbyname, create_connection, getaddrinfo, gethostname, AI_CANONNAME, AF_INET
-from aiodns import DNSResolver
-from aiohttp import ClientSession
+from socket import socket, getaddrinfo, gethostname, AF_INET, SOCK_STREAM, AI_CANONNAME
 from getpass import getuser
 from sys import argv
-from aioopenssl import create_starttls_connection
+from alert_dispatcher import AlertDispatcher
+from cert_cache import CertCache
+from dns_cache import CachingResolver
+from timeout_policy import TimeoutPolicy
+from tls_sessions import TLSSessionCache, TLS_TARGET
 
-CONNECT_TIMEOUT = 3
+CONCURRENCY = 500
 DAYS_THRESHOLD = 12
 INPUT_FILE = "cert_hostnames.txt"
 SMTP_HOSTNAME = "localhost"
@@ -36,86 +36,112 @@ def get_targets(input_file=INPUT_FILE):
     return targets
 
 
-async def check_site(target="localhost", port=443):
+class Scanner:
 
-    site = {
-        'hostname': target.split(":")[0] if ":" in target else target,
-        'port': target.split(":")[1] if ":" in target else port,
-        'status': "unknown",
-        'cert': {},
-    }
+    def __init__(self, concurrency: int = CONCURRENCY):
 
-    # Verify hostname resolves in DNS
-    try:
-        site['ip_address'] = gethostbyname(site['hostname'])
-    except Exception as e:
-        site['status'] = f"Not resolvable in DNS"
-        return site
+        # Shared by every handshake in the run
+        self.concurrency = concurrency
+        self.tls_sessions = TLSSessionCache()
+        self.resolver = CachingResolver()
+        self.cert_cache = CertCache()
+        self.policy = TimeoutPolicy()
 
-    # Verify hostname is reachable
-    try:
-        #ssl_context = SSLContext() #PROTOCOL_TLS)
-        ssl_context = create_default_context()
-        #sock = create_connection((site['hostname'], str(site['port'])), timeout=CONNECT_TIMEOUT)
-        reader = await open_connection(site['hostname'], site['port'], ssl=ssl_context)
-    except Exception as e:
-        site['status'] = f"Not reachable on port {site['port']}"
-        return site
+    async def check_site(self, target="localhost", port=443):
 
-    # Attempt SSL connection
-    try:
-        #ssl_context = create_default_context()
-        #ssock = ssl_context.wrap_socket(sock, server_hostname=site['hostname'])
-        #start_tls(ssl_context, server_hostname=site['hostname'], ssl_handshake_timeout=CONNECT_TIMEOUT)
-        async with ClientSession() as session:
-            async with session.get(f"https://{site['hostname']}/") as r:
-                if r.status:
-                    site['status'] = int(r.status)
-                    #cert_details = await r.connection.transport.get_extra_info('peercert')
-                    cert_details = r.connection.transport._ssl_protocol._extra['ssl_object'].getpeercert(True)
-                else:
-                    site['status'] = "Not responding to HTTP request"
-
-    except Exception as e:
-        #site['info'] = f"TLS handshake to '{site['hostname']}' on port {site['port']} failed"
-        #site['status'] = format(e)
-        return site
+        site = {
+            'hostname': target.split(":")[0] if ":" in target else target,
+            'port': int(target.split(":")[1]) if ":" in target else port,
+            'status': "unknown",
+            'cert': {},
+        }
 
-    conn = await create_starttls_connection(loop=get_event_loop(), host="www.j5.org", port=443, server_hostname="www.j5.org")
-    print(conn)
+        # Verify hostname resolves in DNS
+        if not (ip_address := await self.resolver.resolve(site['hostname'])):
+            site['status'] = "Not resolvable in DNS"
+            return site
+        site['ip_address'] = ip_address
 
-    """
+        # TCP connect and TLS handshake are timed separately, so a host that's down isn't reported as a TLS problem
+        key = f"{site['hostname']}:{site['port']}"
+        sock = socket(AF_INET, SOCK_STREAM)
+        sock.setblocking(False)
+        timeout = self.policy.timeout(key, 'connect')
+        try:
+            started = perf_counter()
+            await wait_for(get_running_loop().sock_connect(sock, (ip_address, site['port'])), timeout)
+            connect_seconds = perf_counter() - started
+        except Exception as e:
+            sock.close()
+            if isinstance(e, TimeoutError):
+                self.policy.record_timeout(key, 'connect', timeout)
+            site['status'] = f"Not reachable on port {site['port']}"
+            return site
+        self.policy.record(key, 'connect', connect_seconds)
+
+        # TLS handshake only; the cert and negotiated version come from the transport, no HTTP request is sent
+        timeout = self.policy.timeout(key, 'tls')
+        try:
+            # Offer the session saved from an earlier handshake with this IP and name, e.g. another name on the same front end
+            TLS_TARGET.set((ip_address, site['hostname']))
+            started = perf_counter()
+            _, writer = await wait_for(open_connection(
+                sock=sock, ssl=self.tls_sessions.context, server_hostname=site['hostname'], ssl_handshake_timeout=timeout
+            ), timeout)
+            tls_seconds = perf_counter() - started
+        except Exception as e:
+            sock.close()
+            if isinstance(e, TimeoutError):
+                self.policy.record_timeout(key, 'tls', timeout)
+                site['status'] = "TLS handshake timed out"
+            else:
+                site['status'] = f"TLS handshake failed: {e.__class__.__name__} {e}".rstrip()
+            return site
+        self.policy.record(key, 'tls', tls_seconds)
+        self.policy.record(key, 'open', connect_seconds + tls_seconds)
 
-    # Attempt to get certificate details
-    #try:
-    #    cert_details = ssock.getpeercert()
-    #except:
-    #    site['info'] = f"Cannot get certificate details for '{site['hostname']}' on port {site['port']} "
-    #    return site
+        try:
+            ssl_object = writer.get_extra_info('ssl_object')
+            site['tls_version'] = ssl_object.version()
+            cert_info = self.cert_cache.get(ssl_object.getpeercert(True), ssl_object.getpeercert())
+            self.tls_sessions.remember(ssl_object)
+        finally:
+            writer.close()
+
+        site['status'] = "OK"
+        site['cert']['issued_timestamp'] = cert_info.issued_timestamp
+        site['cert']['expiration_timestamp'] = cert_info.expiration_timestamp
+        site['cert']['issuer'] = cert_info.issuer
+
+        # Adjust for local timezone setting
+        local_timezone_offset = timezone if (localtime().tm_isdst == 0) else altzone
+        current_timestamp = round(time()) + local_timezone_offset
+
+        # Do math to determine days, hour, seconds remaining until expiration
+        site['cert']['seconds_until_expiration'] = site['cert']['expiration_timestamp'] - current_timestamp
+        site['cert']['hours_until_expiration'] = ceil(site['cert']['seconds_until_expiration'] / 3600)
+        site['cert']['days_until_expiration'] = site['cert']['hours_until_expiration'] // 24
 
-    #print(cert_details)
-    # Get original issue and expiration timestamps
-    site['cert']['issued_timestamp'] = round(mktime(strptime(cert_details['notBefore'], "%b %d %H:%M:%S %Y %Z")));
-    site['cert']['expiration_timestamp'] = round(mktime(strptime(cert_details['notAfter'], "%b %d %H:%M:%S %Y %Z")));
+        return site
 
-    # Adjust for local timezone setting
-    local_timezone_offset = timezone if (localtime().tm_isdst == 0) else altzone
-    current_timestamp = round(time()) + local_timezone_offset
+    async def scan(self, targets: list) -> list:
 
-    # Do math to determine days, hour, seconds remaining until expiration
-    site['cert']['seconds_until_expiration'] = site['cert']['expiration_timestamp'] - current_timestamp
-    site['cert']['hours_until_expiration'] = ceil(site['cert']['seconds_until_expiration'] / 3600)
-    site['cert']['days_until_expiration'] = site['cert']['hours_until_expiration'] // 24
+        # A fixed pool of workers pulls from one iterator, so at most 'concurrency' handshakes are in flight
+        results = [None] * len(targets)
+        pending = iter(enumerate(targets))
 
-    """
+        async def worker():
+            for index, target in pending:
+                results[index] = await self.check_site(target)
 
-    return site
+        await gather(*[worker() for _ in range(max(min(self.concurrency, len(targets)), 1))])
+        return results
 
 
 async def main():
 
     if len(argv) < 2:
-        quit(f"Usage: {argv[0]} 'hostnames_file'")
+        quit(f"Usage: {argv[0]} 'hostnames_file' [recipient] [sender]")
     input_file = argv[1]
     recipient = None
     if len(argv) > 2:
@@ -126,32 +152,29 @@ async def main():
         sender = getuser() + "@" + getaddrinfo(gethostname(), 0, flags=AI_CANONNAME)[0][3]
 
     targets = get_targets(input_file)
-    tasks = [check_site(target) for target in targets]
-    results = await gather(*tasks)
-    for result in results:
-        print(result)
-    output = ""
+    results = await Scanner().scan(targets)
+
+    alerts = []
     for result in results:
-        if 'info' in result:
-            output += result.get('info') + '\n'
-        if days_until_expiration := result['cert'].get('days_until_expiration', 365) <= DAYS_THRESHOLD:
+        if result['status'] != "OK":
+            alerts.append((result['hostname'], f"Problem for {result['hostname']}: {result['status']}"))
+            continue
+        if (days_until_expiration := result['cert']['days_until_expiration']) <= DAYS_THRESHOLD:
+            line = f"{result['hostname']} will expire in "
             if days_until_expiration <= 1:
-                output += str(result['cert']['hours_until_expiration']) + " hours!!!\n"
+                line += str(result['cert']['hours_until_expiration']) + " hours!!!"
             else:
-                output += str(result['cert']['days_until_expiration']) + " days\n"
-
-    if recipient and output:
-        subject = "An SSL certificate is expiring soon!"
-        message = f"From: {sender}\nTo: {recipient}\nSubject: {subject}\n{output}"
-        try:
-            server = SMTP(SMTP_HOSTNAME, port=SMTP_PORT)
-            server.ehlo()
-            server.sendmail(sender, recipient, message)
-            server.quit()
-        except Exception as e:
-            print(e)
+                line += str(days_until_expiration) + " days"
+            alerts.append((result['hostname'], line))
+
+    if recipient and alerts:
+        dispatcher = AlertDispatcher(sender, recipient, "An SSL certificate is expiring soon!",
+                                     smtp_hostname=SMTP_HOSTNAME, smtp_port=SMTP_PORT)
+        for key, line in alerts:
+            dispatcher.alert(key, line)
+        dispatcher.close()
     else:
-        print(output, end='')
+        print("".join(line + "\n" for _, line in alerts), end='')
 
 
 if __name__ == "__main__":
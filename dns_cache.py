@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+from asyncio import run, gather, get_running_loop
+from ipaddress import ip_address
+from os import stat
+from socket import AF_INET
+from time import monotonic, perf_counter
+from aiodns import DNSResolver
+from aiodns.error import DNSError, ARES_ENOTFOUND, ARES_ENODATA
+from pycares import QUERY_TYPE_A
+
+DEFAULT_TTL = 300
+MIN_TTL = 5
+NEGATIVE_TTL = 60
+HOSTS_FILE = "/etc/hosts"
+
+
+class CachingResolver:
+
+    def __init__(self, negative_ttl: int = NEGATIVE_TTL):
+
+        self.negative_ttl = negative_ttl
+        self.cache = {}
+        self.pending = {}
+        self.lookup_ms = {}
+        self.resolver = None
+        self.loop = None
+        self.hosts = (None, set())
+
+    async def resolve(self, hostname: str):
+
+        # IP literals don't need a lookup
+        try:
+            return str(ip_address(hostname))
+        except ValueError:
+            pass
+
+        if entry := self.cache.get(hostname):
+            expires, address = entry
+            if expires > monotonic():
+                return address
+
+        # Concurrent lookups for the same name share one query
+        if future := self.pending.get(hostname):
+            return await future
+
+        future = get_running_loop().create_future()
+        self.pending[hostname] = future
+        try:
+            started = perf_counter()
+            try:
+                address, ttl = await self.query(hostname)
+            except Exception:
+                # Cache failures too, so dead names aren't looked up again right away
+                address, ttl = None, self.negative_ttl
+            self.lookup_ms[hostname] = round((perf_counter() - started) * 1000, 1)
+            self.cache[hostname] = (monotonic() + ttl, address)
+            future.set_result(address)
+        finally:
+            del self.pending[hostname]
+            if not future.done():
+                future.cancel()
+        return address
+
+    async def query(self, hostname: str) -> tuple:
+
+        # aiodns is tied to the event loop it was created on, and a cache can outlive a loop (e.g. resolve_all, then probe_all)
+        if not self.resolver or self.loop is not get_running_loop():
+            self.loop = get_running_loop()
+            self.resolver = DNSResolver(loop=self.loop)
+
+        try:
+            # The answer section can start with the CNAME chain; only the A records carry addresses
+            result = await self.resolver.query_dns(hostname, 'A')
+            answers = [record for record in result.answer if record.type == QUERY_TYPE_A]
+            return answers[0].data.addr, max(min(answer.ttl for answer in answers), MIN_TTL)
+        except DNSError as e:
+            # Names that only exist in the hosts file don't come back from a DNS query; anything else that DNS
+            # doesn't know, or that failed to look up, isn't asked about again
+            if e.args[0] not in (ARES_ENOTFOUND, ARES_ENODATA) or hostname.lower() not in self.hosts_names():
+                raise
+        result = await self.resolver.getaddrinfo(hostname, AF_INET)
+        return result.nodes[0].addr[0].decode(), DEFAULT_TTL
+
+    def hosts_names(self) -> set:
+
+        # Every name in the hosts file, re-read only when the file changes
+        try:
+            mtime = stat(HOSTS_FILE).st_mtime
+        except OSError:
+            return set()
+        if self.hosts[0] != mtime:
+            names = set()
+            with open(HOSTS_FILE, 'r') as f:
+                for line in f:
+                    names.update(name.lower() for name in line.split("#")[0].split()[1:])
+            self.hosts = (mtime, names)
+        return self.hosts[1]
+
+
+async def resolve_many(hostnames, resolver: CachingResolver = None) -> dict:
+
+    resolver = resolver if resolver else CachingResolver()
+    hostnames = list(dict.fromkeys(hostnames))
+    addresses = await gather(*[resolver.resolve(hostname) for hostname in hostnames])
+    return dict(zip(hostnames, addresses))
+
+
+def resolve_all(hostnames, resolver: CachingResolver = None) -> dict:
+
+    # Blocking wrapper for the scripts that aren't async
+    return run(resolve_many(hostnames, resolver))
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+from asyncio import create_task, sleep, to_thread, CancelledError
+from datetime import datetime, timezone
+from aiohttp import ClientResponseError, ClientSession, ClientTimeout, RequestInfo, TCPConnector
+from google.auth import default
+from google.auth.transport.requests import Request
+from ijson import parse_async, ObjectBuilder
+from request_scheduler import RequestScheduler
+from response_cache import ResponseCache
+from yarl import URL
+
+SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
+LIMIT = 100
+LIMIT_PER_HOST = 20
+KEEPALIVE_SECONDS = 60
+DNS_TTL = 300
+TIMEOUT = 60
+REFRESH_MARGIN = 300
+REFRESH_RETRY = 30
+USER_AGENT = "gcp_functions (gzip)"
+
+# Projects without the API enabled answer with a 404, or a 403 giving one of these reasons. Other 403s are quota,
+# rate-limit or IAM refusals, which are real failures and may well go away on the next run
+DISABLED_REASONS = ('SERVICE_DISABLED', 'accessNotConfigured')
+
+# APIs whose list calls return their resources under 'items' rather than under the collection name
+ITEMS_APIS = ('compute', 'sqladmin', 'storage')
+
+
+def make_url(call: str, api_name: str = None) -> str:
+
+    # Takes a full URL, or a path like "compute/v1/projects/..." on the API's own googleapis.com host
+    if call.startswith("https://"):
+        return call
+    call = call[1:] if call.startswith("/") else call
+    api_name = api_name if api_name else call.split("/")[0]
+    return f"https://{api_name}.googleapis.com/{call}"
+
+
+class APIError(ClientResponseError):
+
+    def __init__(self, request_info, history, status: int, message: str = "", headers=None, disabled: bool = False):
+
+        super().__init__(request_info, history, status=status, message=message, headers=headers)
+        # True when the API isn't enabled in the project, so there's nothing there to list
+        self.disabled = disabled
+
+
+async def raise_for_status(response):
+
+    # Like aiohttp's raise_for_status, but reads Google's error body to tell a disabled API from other refusals
+    if response.status < 400:
+        return
+    reasons = []
+    message = response.reason
+    try:
+        error = (await response.json(content_type=None))['error']
+        message = error.get('message', message)
+        reasons = [detail.get('reason') for detail in error.get('errors', []) + error.get('details', [])]
+    except Exception:
+        pass
+    disabled = response.status == 404 or (response.status == 403 and any(reason in DISABLED_REASONS for reason in reasons))
+    raise APIError(response.request_info, response.history, response.status, message, response.headers, disabled)
+
+
+def is_disabled(e: Exception) -> bool:
+
+    return isinstance(e, APIError) and e.disabled
+
+
+def get_api_name(url: str) -> str:
+
+    return url.split("/")[2].split(".")[0]
+
+
+def get_key(url: str) -> str:
+
+    return 'items' if get_api_name(url) in ITEMS_APIS else url.split("?")[0].split("/")[-1]
+
+
+async def read_page(response, key: str, collection: str = None) -> tuple:
+
+    # Builds each resource as its JSON streams in, so a page is never held as text and as objects at the same time
+    items = []
+    page_token = None
+    builder = None
+    depth = 0
+    async for prefix, event, value in parse_async(response.content, use_float=True):
+        if builder:
+            builder.event(event, value)
+            if event in ('start_map', 'start_array'):
+                depth += 1
+            elif event in ('end_map', 'end_array'):
+                depth -= 1
+                if not depth:
+                    items.append(builder.value)
+                    builder = None
+        elif prefix == 'nextPageToken':
+            page_token = value
+        elif is_item(prefix, key, collection):
+            if event in ('start_map', 'start_array'):
+                builder = ObjectBuilder()
+                builder.event(event, value)
+                depth = 1
+            elif event not in ('end_map', 'end_array'):
+                items.append(value)
+    return items, page_token
+
+
+def is_item(prefix: str, key: str, collection: str = None) -> bool:
+
+    if not collection:
+        return prefix == f"{key}.item"
+    # e.g. "items.zones/us-east1-b.instances.item"
+    parts = prefix.split(".")
+    return len(parts) == 4 and parts[0] == key and parts[2] == collection and parts[3] == 'item'
+
+
+class GCPClient:
+
+    def __init__(self, limit: int = LIMIT, limit_per_host: int = LIMIT_PER_HOST, timeout: float = TIMEOUT,
+                 scheduler: RequestScheduler = None, cache: ResponseCache = None):
+
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        # Paces requests per API and retries the ones that were throttled
+        self.scheduler = scheduler if scheduler else RequestScheduler(max_in_flight=limit)
+        # Optional on-disk copy of every listing, so unchanged projects aren't listed again on the next run
+        self.cache = cache
+        self.credentials = None
+        self.project_id = None
+        self.session = None
+        self.refresher = None
+
+    async def __aenter__(self):
+
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+
+        await self.close()
+
+    async def start(self):
+
+        self.credentials, self.project_id = default(scopes=SCOPES, quota_project_id=None)
+        await to_thread(self.credentials.refresh, Request())
+
+        # One session for the whole run: connections to each googleapis.com host are kept alive and reused
+        connector = TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                 keepalive_timeout=KEEPALIVE_SECONDS, use_dns_cache=True, ttl_dns_cache=DNS_TTL)
+        self.session = ClientSession(connector=connector, raise_for_status=True,
+                                     timeout=ClientTimeout(total=self.timeout))
+        self.refresher = create_task(self.refresh_token())
+
+    async def close(self):
+
+        if self.refresher:
+            self.refresher.cancel()
+            try:
+                await self.refresher
+            except CancelledError:
+                pass
+            self.refresher = None
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def refresh_token(self):
+
+        # Tokens last about an hour, so long runs get a new one shortly before it expires, without stalling requests
+        while True:
+            delay = REFRESH_RETRY
+            if expiry := self.credentials.expiry:
+                # google-auth keeps the expiry as a naive UTC datetime
+                now = datetime.now(timezone.utc).replace(tzinfo=None)
+                delay = max((expiry - now).total_seconds() - REFRESH_MARGIN, REFRESH_RETRY)
+            await sleep(delay)
+            try:
+                await to_thread(self.credentials.refresh, Request())
+            except Exception:
+                # The current token is still valid for a few minutes; try again shortly
+                pass
+
+    @property
+    def headers(self) -> dict:
+
+        # Google only gzips responses for clients whose User-Agent says they accept it
+        return {'Authorization': f"Bearer {self.credentials.token}", 'User-Agent': USER_AGENT}
+
+    async def get(self, call: str, api_name: str = None, params: dict = None) -> dict:
+
+        url = make_url(call, api_name)
+        params = dict(params) if params else None
+
+        async def request():
+            async with self.session.get(url, headers=self.headers, params=params) as response:
+                return await response.json()
+
+        return await self.scheduler.call(get_api_name(url), request)
+
+    async def iterate(self, call: str, api_name: str = None, key: str = None, params: dict = None, fields: str = None):
+
+        url = make_url(call, api_name)
+        key = key if key else get_key(url)
+        params = dict(params) if params else {}
+        # Aggregated lists are grouped by zone or region, each under the resource's collection name
+        collection = url.split("?")[0].split("/")[-1] if '/aggregated/' in url else None
+        if fields:
+            # Partial response: only the fields the caller uses are sent, plus what's needed to page
+            params['fields'] = f"nextPageToken,{fields}"
+
+        entry = {}
+        if self.cache:
+            cache_path = self.cache.path(url, get_api_name(url), params)
+            entry = self.cache.get(cache_path)
+            if self.cache.is_fresh(entry):
+                self.cache.fresh += 1
+                if entry.get('status'):
+                    raise APIError(RequestInfo(URL(url), 'GET', {}), (), entry['status'], "API not enabled (cached)", disabled=True)
+                for item in entry['items']:
+                    yield item
+                return
+
+        # Follows nextPageToken until the last page, handing back one page of resources at a time
+        items = []
+        etag = None
+        while True:
+            page_params = dict(params)
+            # A listing that fit on one page can be revalidated with its ETag instead of downloaded again
+            revalidate = entry.get('etag') if 'pageToken' not in params else None
+
+            async def request():
+                headers = self.headers
+                if revalidate:
+                    headers['If-None-Match'] = revalidate
+                async with self.session.get(url, headers=headers, params=page_params, raise_for_status=False) as response:
+                    if response.status == 304:
+                        return None
+                    await raise_for_status(response)
+                    return await read_page(response, key, collection) + (response.headers.get('ETag'),)
+
+            try:
+                page = await self.scheduler.call(get_api_name(url), request)
+            except APIError as e:
+                # Remember that the API is off in this project, so the next run doesn't ask again
+                if self.cache and e.disabled:
+                    self.cache.fetched += 1
+                    self.cache.put(cache_path, [], status=e.status)
+                raise
+            if not page:
+                self.cache.revalidated += 1
+                self.cache.touch(cache_path, entry)
+                for item in entry['items']:
+                    yield item
+                return
+
+            page_items, page_token, page_etag = page
+            etag = page_etag if 'pageToken' not in params and not page_token else None
+            if self.cache:
+                items.extend(page_items)
+            for item in page_items:
+                yield item
+            if not page_token:
+                break
+            params['pageToken'] = page_token
+
+        if self.cache:
+            self.cache.fetched += 1
+            self.cache.put(cache_path, items, etag)
+
+    async def list(self, call: str, api_name: str = None, key: str = None, params: dict = None, fields: str = None) -> list:
+
+        return [item async for item in self.iterate(call, api_name, key, params, fields)]
@@ -1,70 +1,36 @@
 #!/usr/bin/env python3 
 
 from asyncio import run, gather, create_task
-from aiohttp import ClientSession
-from google.auth import default
-from google.auth.transport.requests import Request
+from collections import Counter
+from argparse import ArgumentParser
+from gcp_functions import GCPClient, is_disabled
+from history_store import parse_age
+from ip_index import inventory_key
+from response_cache import ResponseCache, CACHE_DIR, MAX_AGE
 import csv
+import sys
 
 CSV_FILE = 'gcp_ip_addresses.csv'
 
 
-async def make_gcp_call(call: str, access_token: str, api_name: str) -> list:
-
-    results = []
-
-    call = call[1:] if call.startswith("/") else call
-    url = f"https://{api_name}.googleapis.com/{call}"
-    key = 'items' if api_name in ['compute', 'sqladmin'] else url.split("/")[-1]
-
-    try:
-        headers = {'Authorization': f"Bearer {access_token}"}
-        params = {}
-        async with ClientSession(raise_for_status=True) as session:
-            while True:
-                async with session.get(url, headers=headers, params=params) as response:
-                    if int(response.status) == 200:
-                        json = await response.json()
-                        if 'aggregated/' in url:
-                            items = json.get(key, {})
-                            for k, v in items.items():
-                                results.extend(v.get(url.split("/")[-1], []))
-                        else:
-                            results.extend(json.get(key, []))
-                        if page_token := json.get('nextPageToken'):
-                            params.update({'pageToken': page_token})
-                        else:
-                            break
-                    else:
-                        raise response
-        return results
-    except Exception as e:
-        await session.close()
-        return []
-
-
-async def get_project_ids(access_token: str) -> list:
+async def get_project_ids(client: GCPClient) -> list:
 
     try:
         api_name = "cloudresourcemanager"
         call = "/v1/projects"
-        projects = await make_gcp_call(call, access_token, api_name)
-        return [p['projectId'] for p in projects]
+        return [p['projectId'] async for p in client.iterate(call, api_name, fields="projects(projectId)")]
     except Exception as e:
         raise e
 
 
-async def get_instance_nics(project_id: str, access_token: str) -> list:
+async def get_instance_nics(project_id: str, client: GCPClient) -> list:
 
-    try:
-        api_name = "compute"
-        call = f"/compute/v1/projects/{project_id}/aggregated/instances"
-        items = await make_gcp_call(call, access_token, api_name)
-    except:
-        return []
+    api_name = "compute"
+    call = f"/compute/v1/projects/{project_id}/aggregated/instances"
+    fields = "items/*/instances(name,zone,networkInterfaces(network,networkIP,accessConfigs(name,natIP)))"
 
     results = []
-    for item in items:
+    async for item in client.iterate(call, api_name, fields=fields):
         for nic in item.get('networkInterfaces', []):
             if network := nic.get('network'):
                 network_name = network.split("/")[-1]
@@ -94,19 +60,17 @@ async def get_instance_nics(project_id: str, access_token: str) -> list:
     return results
 
 
-async def get_fwd_rules(project_id: str, access_token: str) -> list:
+async def get_fwd_rules(project_id: str, client: GCPClient) -> list:
 
-    try:
-        api_name = "compute"
-        calls = [
-            f"/compute/v1/projects/{project_id}/aggregated/forwardingRules",
-            f"/compute/v1/projects/{project_id}/global/forwardingRules",
-        ]
-        items = []
-        for call in calls:
-            items.extend(await make_gcp_call(call, access_token, api_name))
-    except:
-        return []
+    api_name = "compute"
+    fields = "name,IPAddress,network,region"
+    calls = {
+        f"/compute/v1/projects/{project_id}/aggregated/forwardingRules": f"items/*/forwardingRules({fields})",
+        f"/compute/v1/projects/{project_id}/global/forwardingRules": f"items({fields})",
+    }
+    items = []
+    for call, call_fields in calls.items():
+        items.extend(await client.list(call, api_name, fields=call_fields))
 
     results = []
     for item in items:
@@ -127,20 +91,18 @@ async def get_fwd_rules(project_id: str, access_token: str) -> list:
     return results
 
 
-async def get_cloudsql_instances(project_id: str, access_token: str) -> list:
+async def get_cloudsql_instances(project_id: str, client: GCPClient) -> list:
 
-    try:
-        api_name = "sqladmin"
-        call = f"/v1/projects/{project_id}/instances"
-        items = await make_gcp_call(call, access_token, api_name)
-    except:
-        return []
+    api_name = "sqladmin"
+    call = f"/v1/projects/{project_id}/instances"
+    fields = "items(name,region,settings/ipConfiguration/privateNetwork,ipAddresses/ipAddress)"
 
     results = []
-    for item in items:
+    async for item in client.iterate(call, api_name, fields=fields):
         network_project_id = "unknown"
         network_name = "unknown"
-        if ip_configuration := item['settings'].get('ipConfiguration'):
+        # With a partial response, settings is left out entirely when there's no private network
+        if ip_configuration := item.get('settings', {}).get('ipConfiguration'):
             if network := ip_configuration.get('privateNetwork'):
                 network_project_id = network.split("/")[-4]
                 network_name = network.split("/")[-1]
@@ -156,17 +118,14 @@ async def get_cloudsql_instances(project_id: str, access_token: str) -> list:
     return results
 
 
-async def get_gke_endpoints(project_id: str, access_token: str) -> list:
+async def get_gke_endpoints(project_id: str, client: GCPClient) -> list:
 
-    try:
-        api_name = "container"
-        call = f"/v1/projects/{project_id}/locations/-/clusters"
-        clusters = await make_gcp_call(call, access_token, api_name)
-    except:
-        return []
+    api_name = "container"
+    call = f"/v1/projects/{project_id}/locations/-/clusters"
+    fields = "clusters(name,location,networkConfig/network,privateClusterConfig(publicEndpoint,privateEndpoint,enablePrivateEndpoint))"
 
     results = []
-    for cluster in clusters:
+    async for cluster in client.iterate(call, api_name, fields=fields):
         network_project_id = "unknown"
         network_name = "unknown"
         endpoint_ips = []
@@ -174,11 +133,11 @@ async def get_gke_endpoints(project_id: str, access_token: str) -> list:
             endpoint_ips.append(private_cluster_config.get('publicEndpoint'))
             if private_cluster_config.get('enablePrivateEndpoint'):
                 endpoint_ips.append(private_cluster_config.get('privateEndpoint'))
-        if node_pools := cluster.get('nodePools'):
-            if network_config := node_pools[0].get('networkConfig'):
-                if network := network_config.get('network'):
-                    network_project_id = network.split("/")[-4]
-                    network_name = network.split("/")[-1]
+        # The cluster's networkConfig has the full network path; node pools' networkConfig has no network field
+        if network_config := cluster.get('networkConfig'):
+            if network := network_config.get('network'):
+                network_project_id = network.split("/")[-4]
+                network_name = network.split("/")[-1]
         location = cluster.get('location', "unknown-0")
         for endpoint_ip in endpoint_ips:
             results.append({
@@ -195,34 +154,65 @@ async def get_gke_endpoints(project_id: str, access_token: str) -> list:
     return results
 
 
-async def main():
+COLLECTORS = [get_instance_nics, get_fwd_rules, get_cloudsql_instances, get_gke_endpoints]
+
+
+async def main(cache: ResponseCache = None):
 
+    client = GCPClient(cache=cache)
     try:
-        scopes = ['https://www.googleapis.com/auth/cloud-platform']
-        credentials, project_id = default(scopes=scopes, quota_project_id=None)
-        credentials.refresh(Request())
-        access_token = credentials.token
-        project_ids = await get_project_ids(access_token)
+        await client.start()
+        project_ids = await get_project_ids(client)
     except Exception as e:
+        await client.close()
         quit(e)
 
-    tasks = []
-    for project_id in project_ids:
-        tasks.append(create_task(get_instance_nics(project_id, access_token)))
-        tasks.append(create_task(get_fwd_rules(project_id, access_token)))
-        tasks.append(create_task(get_cloudsql_instances(project_id, access_token)))
-        tasks.append(create_task(get_gke_endpoints(project_id, access_token)))
+    try:
+        # Every call goes through the client's scheduler, which caps requests per API and in flight overall
+        tasks = {}
+        for project_id in project_ids:
+            for collector in COLLECTORS:
+                tasks[(project_id, collector.__name__)] = create_task(collector(project_id, client))
+        results = await gather(*tasks.values(), return_exceptions=True)
+    finally:
+        await client.close()
 
     ip_addresses = []
-    for _ in await gather(*tasks):
-        ip_addresses.extend(_)
+    skipped = Counter()
+    failures = []
+    for (project_id, collector), result in zip(tasks, results):
+        if not isinstance(result, Exception):
+            ip_addresses.extend(result)
+        elif is_disabled(result):
+            # The API isn't enabled in this project, so there's nothing to list; other refusals are failures
+            skipped[collector] += 1
+        else:
+            failures.append(f"{project_id} {collector}: {result.__class__.__name__} {result}".rstrip())
+
+    for line in client.scheduler.report():
+        print(line, file=sys.stderr)
+    if cache:
+        print(cache.report(), file=sys.stderr)
+    for collector, count in skipped.items():
+        print(f"{collector}: skipped {count} projects without the API enabled", file=sys.stderr)
+    for line in failures:
+        print(f"Failed: {line}", file=sys.stderr)
 
-    return ip_addresses
+    return ip_addresses, failures
 
 if __name__ == "__main__":
 
-    _ = run(main())
-    data = sorted(_, key=lambda x: x['ip_address'], reverse=False)
+    parser = ArgumentParser()
+    parser.add_argument("--max-age", type=parse_age, default=MAX_AGE,
+                        help="reuse cached listings younger than this (e.g. 90, 15m, 6h, 1d); older ones are revalidated or fetched again")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="where listings are cached between runs")
+    parser.add_argument("--no-cache", action="store_true", help="list everything from the APIs, and don't update the cache")
+    args = parser.parse_args()
+
+    cache = None if args.no_cache else ResponseCache(args.cache_dir, args.max_age)
+    _, failures = run(main(cache))
+    # Numeric order, IPv4 before IPv6; sorting the strings put 10.0.0.100 before 10.0.0.2
+    data = sorted(_, key=lambda x: inventory_key(x['ip_address']))
 
     #print(ip_addresses)
 
@@ -231,3 +221,6 @@ if __name__ == "__main__":
     writer.writerow(data[0].keys())
     [writer.writerow(row.values()) for row in data]
     csvfile.close()
+
+    if failures:
+        sys.exit(f"{CSV_FILE} is incomplete: {len(failures)} calls failed")
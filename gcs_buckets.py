@@ -1,39 +1,14 @@
 #!/usr/bin/env python3 
 
-from oauth2client.client import GoogleCredentials
 from asyncio import run, gather, create_task
-from aiohttp import ClientSession
-import yaml
+from gcp_functions import GCPClient
 
 
-async def make_async_call(url: str, access_token: str, key: str = 'items') -> list:
-
-    results = []
-
-    try:
-        headers = {'Authorization': f"Bearer {access_token}"}
-        async with ClientSession(raise_for_status=True) as session:
-            page_token = None
-            while True:
-                params = {'pageToken': page_token} if page_token else {}
-                async with session.get(url=url, headers=headers, params=params) as response:
-                    if int(response.status) == 200:
-                        data = await response.json()
-                        results.extend(data.get(key, []))
-                        if page_token := data.get('nextPageToken'):
-                            params.update({'pageToken': page_token})
-                        else:
-                            break
-        return results
-    except Exception as e:
-        return []
-
-
-async def get_projects(access_token: str) -> list:
+async def get_projects(client: GCPClient) -> list:
 
     try:
         url = "https://cloudresourcemanager.googleapis.com/v1/projects"
-        projects = await make_async_call(url, access_token, key='projects')
+        projects = await client.list(url, key='projects', fields="projects(projectId,projectNumber)")
         _ = {}
         for project in projects:
             _.update({int(project['projectNumber']): project['projectId']})
@@ -42,23 +17,24 @@ async def get_projects(access_token: str) -> list:
         quit(e)
 
 
-async def get_buckets(project_id: str, access_token: str) -> list:
+async def get_buckets(project_id: str, client: GCPClient) -> list:
 
     try:
-        url = f"https://storage.googleapis.com/storage/v1/b?project={project_id}"
-        return await make_async_call(url, access_token)
+        url = "https://storage.googleapis.com/storage/v1/b"
+        fields = "items(name,location,storageClass,projectNumber)"
+        return await client.list(url, params={'project': project_id}, fields=fields)
     except Exception as e:
         print(e)
         return []
 
 
-async def get_objects(bucket_name: str, access_token: str):
+async def get_objects(bucket_name: str, client: GCPClient):
 
     total_size = 0
     params = {'prefix': ''}
     try:
-        url = f"https://storage.googleapis.com/storage/v1/b/{bucket_name}/o?prefix="
-        _ = await make_async_call(url, access_token)
+        url = f"https://storage.googleapis.com/storage/v1/b/{bucket_name}/o"
+        _ = await client.list(url, params=params, fields="items(size)")
         num_objects = len(_)
         for o in _:
             if size := int(o.get('size', 0)):
@@ -72,13 +48,13 @@ async def get_objects(bucket_name: str, access_token: str):
 async def main():
 
     try:
-        creds = GoogleCredentials.get_application_default()
-        access_token = creds.get_access_token().access_token
-        projects = await get_projects(access_token)
+        client = GCPClient()
+        await client.start()
+        projects = await get_projects(client)
 
         tasks = []
         for project_id in ["otc-core-network-prod-4aea"]: #projects.values():
-            tasks.append(create_task(get_buckets(project_id, access_token)))
+            tasks.append(create_task(get_buckets(project_id, client)))
         buckets = []
         for _ in await gather(*tasks):
             buckets.extend(_)
@@ -89,10 +65,12 @@ async def main():
                 'class': bucket.get('storageClass', 'UNKNOWN'),
                 'project_id': projects.get(int(bucket['projectNumber']), "error"),
             }
-            _['num_objects'], _['total_size'] = await get_objects(_['name'], access_token)
+            _['num_objects'], _['total_size'] = await get_objects(_['name'], client)
             print(_)
     except Exception as e:
         quit(e)
+    finally:
+        await client.close()
 
 if __name__ == "__main__":
     run(main())
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+import sqlite3
+from argparse import ArgumentParser
+from time import time, strftime, localtime, perf_counter
+
+HISTORY_FILE = "results.db"
+RAW_SECONDS = 2 * 86400
+MINUTE_SECONDS = 14 * 86400
+RETENTION_SECONDS = 90 * 86400
+RESOLUTIONS = {'raw': 0, 'minute': 60, 'hour': 3600}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    url TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    status TEXT,
+    tls TEXT,
+    connect_ms REAL,
+    ttfb_ms REAL
+);
+CREATE INDEX IF NOT EXISTS samples_url_timestamp ON samples (url, timestamp);
+CREATE TABLE IF NOT EXISTS rollups (
+    url TEXT NOT NULL,
+    resolution INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    errors INTEGER NOT NULL,
+    status TEXT,
+    tls TEXT,
+    connect_ms REAL,
+    connect_ms_max REAL,
+    ttfb_ms REAL,
+    ttfb_ms_max REAL,
+    connect_count INTEGER,
+    ttfb_count INTEGER,
+    PRIMARY KEY (url, resolution, timestamp)
+) WITHOUT ROWID;
+"""
+
+# A sample counts as an error unless the status is a 2xx/3xx code
+IS_ERROR = "(status IS NULL OR status NOT GLOB '[23][0-9][0-9]*')"
+
+# Columns added to rollups after the first release, with the value they have in older rows
+ROLLUP_COLUMNS = {'connect_count': "count", 'ttfb_count': "count"}
+
+
+def parse_age(value: str) -> int:
+
+    # Accepts plain seconds or a number with an s/m/h/d suffix, e.g. "90", "15m", "6h", "7d"
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if value[-1].lower() in units:
+        return int(float(value[:-1]) * units[value[-1].lower()])
+    return int(float(value))
+
+
+class HistoryStore:
+
+    def __init__(self, history_file: str = HISTORY_FILE, raw_seconds: int = RAW_SECONDS,
+                 minute_seconds: int = MINUTE_SECONDS, retention_seconds: int = RETENTION_SECONDS):
+
+        self.raw_seconds = raw_seconds
+        self.minute_seconds = minute_seconds
+        self.retention_seconds = retention_seconds
+
+        # WAL keeps appends cheap and lets a query run while a checker is writing
+        self.db = sqlite3.connect(history_file, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.upgrade()
+
+    def upgrade(self):
+
+        # Databases made before a column existed get it added; older rows weight their averages by the sample count
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(rollups)")]
+        with self.db:
+            for column, value in ROLLUP_COLUMNS.items():
+                if column not in columns:
+                    self.db.execute(f"ALTER TABLE rollups ADD COLUMN {column} INTEGER")
+                    self.db.execute(f"UPDATE rollups SET {column} = {value}")
+
+    def add(self, samples: list):
+
+        # Samples are (url, timestamp, status, tls, connect_ms, ttfb_ms); one transaction per batch
+        with self.db:
+            self.db.executemany("INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?)", samples)
+
+    def compact(self, now: float = None):
+
+        # Raw samples become per-minute rollups, minute rollups become hourly ones, and anything past retention goes
+        now = int(now if now else time())
+        with self.db:
+            cutoff = now - self.raw_seconds
+            # Averages only count the samples that have a latency, i.e. not the ones that failed before connecting or
+            # responding, and the counts behind them are kept so hourly rollups can weight them the same way.
+            # The status is the last one in the bucket
+            self.db.execute(f"""
+                INSERT OR REPLACE INTO rollups
+                SELECT url, 60, timestamp / 60 * 60, COUNT(*), SUM({IS_ERROR}),
+                       (SELECT status FROM samples AS last WHERE last.url = samples.url
+                        AND last.timestamp >= samples.timestamp / 60 * 60 AND last.timestamp < samples.timestamp / 60 * 60 + 60
+                        ORDER BY last.timestamp DESC LIMIT 1),
+                       MAX(tls), AVG(connect_ms), MAX(connect_ms), AVG(ttfb_ms), MAX(ttfb_ms), COUNT(connect_ms), COUNT(ttfb_ms)
+                FROM samples WHERE timestamp < ? GROUP BY url, timestamp / 60
+            """, (cutoff // 60 * 60,))
+            self.db.execute("DELETE FROM samples WHERE timestamp < ?", (cutoff // 60 * 60,))
+
+            cutoff = now - self.minute_seconds
+            self.db.execute("""
+                INSERT OR REPLACE INTO rollups
+                SELECT url, 3600, timestamp / 3600 * 3600, SUM(count), SUM(errors),
+                       (SELECT status FROM rollups AS last WHERE last.url = rollups.url AND last.resolution = 60
+                        AND last.timestamp >= rollups.timestamp / 3600 * 3600 AND last.timestamp < rollups.timestamp / 3600 * 3600 + 3600
+                        ORDER BY last.timestamp DESC LIMIT 1),
+                       MAX(tls), SUM(connect_ms * connect_count) / SUM(connect_count), MAX(connect_ms_max),
+                       SUM(ttfb_ms * ttfb_count) / SUM(ttfb_count), MAX(ttfb_ms_max), SUM(connect_count), SUM(ttfb_count)
+                FROM rollups WHERE resolution = 60 AND timestamp < ? GROUP BY url, timestamp / 3600
+            """, (cutoff // 3600 * 3600,))
+            self.db.execute("DELETE FROM rollups WHERE resolution = 60 AND timestamp < ?", (cutoff // 3600 * 3600,))
+
+            cutoff = now - self.retention_seconds
+            self.db.execute("DELETE FROM samples WHERE timestamp < ?", (cutoff,))
+            self.db.execute("DELETE FROM rollups WHERE timestamp < ?", (cutoff,))
+
+    def query(self, url: str, since: int, until: int = None) -> list:
+
+        # Raw samples and rollups never overlap, so one pass over each covers the whole range in time order
+        until = until if until else int(time())
+        return self.db.execute(f"""
+            SELECT timestamp, 0, 1, {IS_ERROR}, status, tls, connect_ms, connect_ms, ttfb_ms, ttfb_ms, ttfb_ms IS NOT NULL
+            FROM samples WHERE url = ? AND timestamp BETWEEN ? AND ?
+            UNION ALL
+            SELECT timestamp, resolution, count, errors, status, tls, connect_ms, connect_ms_max, ttfb_ms, ttfb_ms_max, ttfb_count
+            FROM rollups WHERE url = ? AND timestamp BETWEEN ? AND ?
+            ORDER BY timestamp
+        """, (url, since, until, url, since, until)).fetchall()
+
+    def summary(self, url: str, since: int, until: int = None) -> dict:
+
+        rows = self.query(url, since, until)
+        # The average TTFB is weighted by how many samples in each row had one, so errors don't dilute it
+        count = sum(row[2] for row in rows)
+        ttfb_count = sum(row[10] for row in rows if row[8] is not None)
+        return {
+            'samples': count,
+            'errors': sum(row[3] for row in rows),
+            'avg_ttfb_ms': round(sum(row[8] * row[10] for row in rows if row[8] is not None) / ttfb_count, 1) if ttfb_count else None,
+            'max_ttfb_ms': max((row[9] for row in rows if row[9] is not None), default=None),
+            'last_status': rows[-1][4] if rows else None,
+        }
+
+    def close(self):
+
+        self.db.close()
+
+
+def main():
+
+    from prettytable import PrettyTable
+
+    parser = ArgumentParser(description="Query probe history for one URL")
+    parser.add_argument("url")
+    parser.add_argument("--history", default=HISTORY_FILE, help="History database")
+    parser.add_argument("--since", default="7d", help="How far back to look, e.g. 90m, 6h, 7d")
+    parser.add_argument("--until", default="0", help="How long ago the range ends")
+    parser.add_argument("--summary", action="store_true", help="Only print totals for the range")
+    parser.add_argument("--compact", action="store_true", help="Roll up old samples and apply retention first")
+    args = parser.parse_args()
+
+    store = HistoryStore(args.history)
+    if args.compact:
+        store.compact()
+
+    started = perf_counter()
+    now = int(time())
+    since, until = now - parse_age(args.since), now - parse_age(args.until)
+    if args.summary:
+        result = store.summary(args.url, since, until)
+    else:
+        resolutions = {seconds: name for name, seconds in RESOLUTIONS.items()}
+        t = PrettyTable()
+        t.field_names = ["Time", "Resolution", "Samples", "Errors", "Status", "TLS", "Connect ms", "TTFB ms", "Max TTFB ms"]
+        for row in store.query(args.url, since, until):
+            timestamp, resolution, count, errors, status, tls, connect_ms, _, ttfb_ms, ttfb_ms_max, _ = row
+            t.add_row([strftime('%Y-%m-%d %H:%M:%S', localtime(timestamp)), resolutions.get(resolution, resolution),
+                       count, errors, status, tls,
+                       round(connect_ms, 1) if connect_ms is not None else None,
+                       round(ttfb_ms, 1) if ttfb_ms is not None else None,
+                       round(ttfb_ms_max, 1) if ttfb_ms_max is not None else None])
+        result = t
+    print(result)
+    print(f"query_ms: {round((perf_counter() - started) * 1000, 1)}")
+    store.close()
+
+
+if __name__ == "__main__":
+
+    main()
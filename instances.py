@@ -2,28 +2,26 @@
 
 from asyncio import run, gather, create_task
 from collections import Counter
-from google.auth import default
-from google.auth.transport.requests import Request
-from gcp_functions import make_async_call
+from gcp_functions import GCPClient
 
 
-async def get_projects(access_token: str) -> list:
+async def get_projects(client: GCPClient) -> list:
 
     url = "https://cloudresourcemanager.googleapis.com/v1/projects"
     try:
-        projects = await make_async_call(url, access_token, key='projects')
-        return [project['projectId'] for project in projects]
+        return [project['projectId'] async for project in client.iterate(url, key='projects', fields="projects(projectId)")]
     except Exception as e:
         raise e
 
 
-async def get_nics(project_id: str, access_token: str) -> list:
+async def get_nics(project_id: str, client: GCPClient) -> list:
 
     nics = []
 
     url = f"compute/v1/projects/{project_id}/aggregated/instances"
+    fields = "items/*/instances(name,zone,networkInterfaces/network)"
     try:
-        instances = await make_async_call(url, access_token)
+        instances = await client.list(url, fields=fields)
     except:
         return []
 
@@ -43,22 +41,24 @@ async def get_nics(project_id: str, access_token: str) -> list:
 
 async def main():
 
+    client = GCPClient()
     try:
-        scopes = ['https://www.googleapis.com/auth/cloud-platform']
-        credentials, project_id = default(scopes=scopes, quota_project_id=None)
-        credentials.refresh(Request())
-        access_token = credentials.token
-        project_ids = await get_projects(access_token)
+        await client.start()
+        project_ids = await get_projects(client)
     except Exception as e:
+        await client.close()
         quit(e)
     #print(project_ids)
 
     print(f"Counting instances across {len(project_ids)} projects...")
 
-    tasks = [create_task(get_nics(p, access_token)) for p in project_ids]
-    nics = []
-    for _ in await gather(*tasks):
-        nics.extend(_)
+    try:
+        tasks = [create_task(get_nics(p, client)) for p in project_ids]
+        nics = []
+        for _ in await gather(*tasks):
+            nics.extend(_)
+    finally:
+        await client.close()
     #print(nics)
 
     counter = {}
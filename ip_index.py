@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from bisect import bisect_left, bisect_right
+from csv import DictReader, writer
+from ipaddress import ip_address, ip_network, IPv4Address, IPv6Address
+from sys import stdout
+
+CSV_FILE = "gcp_ip_addresses.csv"
+COLUMNS = ['ip_address', 'type', 'name', 'project_id', 'network_id', 'region']
+
+
+def sort_key(address) -> int:
+
+    # IPv4 sorts before IPv6, each numerically; the version goes in the high bits so one int orders both
+    if not isinstance(address, (IPv4Address, IPv6Address)):
+        address = ip_address(address)
+    return address.version << 128 | int(address)
+
+
+def inventory_key(address: str) -> int:
+
+    # For sorting records: anything that isn't an IP (e.g. an empty field) goes last
+    try:
+        return sort_key(address)
+    except ValueError:
+        return 7 << 128
+
+
+class IPIndex:
+
+    def __init__(self, records):
+
+        # Parallel lists, sorted by address: keys for bisect, records for the answers
+        rows = []
+        for record in records:
+            try:
+                rows.append((sort_key(record['ip_address']), record))
+            except ValueError:
+                continue
+        rows.sort(key=lambda row: row[0])
+        self.keys = [key for key, _ in rows]
+        self.records = [record for _, record in rows]
+
+    def lookup(self, address: str) -> list:
+
+        # Private ranges are reused across VPCs, so one address can have several owners
+        key = sort_key(address)
+        return self.records[bisect_left(self.keys, key):bisect_right(self.keys, key)]
+
+    def within(self, cidr: str) -> list:
+
+        network = ip_network(cidr, strict=False)
+        start = bisect_left(self.keys, sort_key(network.network_address))
+        end = bisect_right(self.keys, sort_key(network.broadcast_address))
+        return self.records[start:end]
+
+    def query(self, query: str = None, network_id: str = None) -> list:
+
+        if not query:
+            records = self.records
+        elif "/" in query:
+            records = self.within(query)
+        else:
+            records = self.lookup(query)
+        if network_id:
+            records = [record for record in records if record.get('network_id') == network_id]
+        return records
+
+
+def load(csv_file: str = CSV_FILE) -> IPIndex:
+
+    with open(csv_file, 'r', newline='') as f:
+        return IPIndex(DictReader(f))
+
+
+def main():
+
+    parser = ArgumentParser(description="Look up addresses in the inventory written by gcp_ip_addresses.py, without calling GCP")
+    parser.add_argument("queries", nargs="*", help="IP addresses and/or CIDR ranges, e.g. 10.4.7.22 10.4.0.0/16")
+    parser.add_argument("--network", help="only records on this network_id, e.g. my-host-project/my-vpc")
+    parser.add_argument("--csv", default=CSV_FILE, help="inventory to read")
+    args = parser.parse_args()
+
+    if not (args.queries or args.network):
+        parser.error("give at least one IP address or CIDR range, or --network")
+
+    index = load(args.csv)
+    records = []
+    for query in args.queries if args.queries else [None]:
+        try:
+            records.extend(index.query(query, args.network))
+        except ValueError as e:
+            parser.error(str(e))
+
+    output = writer(stdout)
+    output.writerow(COLUMNS)
+    for record in records:
+        output.writerow([record.get(column) for column in COLUMNS])
+
+
+if __name__ == "__main__":
+    main()
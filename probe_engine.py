@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+
+from asyncio import Queue, Event, Semaphore, TimeoutError, FIRST_COMPLETED, create_task, gather, get_running_loop, \
+    new_event_loop, open_connection, run, wait, wait_for
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED as FUTURES_FIRST_COMPLETED, wait as wait_futures
+from itertools import islice
+from zlib import crc32
+from heapq import heappush, heappop
+from random import random, uniform
+from socket import socket, AF_INET, SOCK_STREAM
+from math import ceil
+from time import time, localtime, timezone, altzone, perf_counter
+from cert_cache import CertCache, CERT_CACHE
+from dns_cache import CachingResolver
+from scan_planner import IPBudget, chunk_by_ip
+from timeout_policy import TimeoutPolicy
+from tls_sessions import TLSSessionCache, TLS_TARGET
+
+CONCURRENCY = 100
+JITTER = 0.1
+CHUNK_SIZE = 256
+RETRIES = 1
+USER_AGENT = "Python http.client"
+
+
+class ProbeResult:
+
+    def __init__(self, target: str, port: int = 443):
+
+        if ":" in target:
+            self.hostname, self.port = target.split(":")
+            self.port = int(self.port)
+        else:
+            self.hostname = target
+            self.port = port
+
+        self.is_resolvable = False
+        self.is_reachable = False
+        self.ip_address = None
+        self.tls_info = None
+        self.cert_details = None
+        self.cert_info = None
+        self.cert_fingerprint = None
+        self.http_status = None
+        self.issued_timestamp = None
+        self.expiration_timestamp = None
+
+        # Per-phase timings in milliseconds, None if the phase never ran
+        self.dns_ms = None
+        self.connect_ms = None
+        self.tls_ms = None
+        self.ttfb_ms = None
+
+    def calc_ssl_expiration(self):
+
+        if not (self.tls_info and self.cert_info):
+            return
+
+        # Get original issue and expiration timestamps, parsed once per distinct cert
+        self.issued_timestamp = self.cert_info.issued_timestamp
+        self.expiration_timestamp = self.cert_info.expiration_timestamp
+        self.expiration_datetime = self.cert_info.not_after
+
+        # Adjust for local timezone setting
+        local_timezone_offset = timezone if localtime().tm_isdst == 0 else altzone
+        current_timestamp = round(time()) + local_timezone_offset
+
+        # Do math to determine days, hour, seconds remaining until expiration
+        self.seconds_until_expiration = self.expiration_timestamp - current_timestamp
+        self.hours_until_expiration = ceil(self.seconds_until_expiration / 3600)
+        self.days_until_expiration = self.hours_until_expiration // 24
+
+
+class ProbeContext:
+
+    def __init__(self, resolver: CachingResolver = None, cert_cache: CertCache = None, policy: TimeoutPolicy = None,
+                 hedge: bool = False, tls_sessions: TLSSessionCache = None, ip_budget: IPBudget = None):
+
+        # State shared by every probe in a run (or for the life of a daemon)
+        self.resolver = resolver if resolver else CachingResolver()
+        self.cert_cache = cert_cache if cert_cache else CERT_CACHE
+        self.policy = policy if policy else TimeoutPolicy()
+        self.hedge = hedge
+        self.tls_sessions = tls_sessions if tls_sessions else TLSSessionCache()
+        self.ip_budget = ip_budget
+
+
+class ConnectError(Exception):
+    pass
+
+
+class HandshakeError(Exception):
+    pass
+
+
+async def _open(result: ProbeResult, context: ProbeContext, key: str) -> tuple:
+
+    # One attempt at a TCP connect plus, on port 443, a TLS handshake over the same socket
+    loop = get_running_loop()
+    policy = context.policy
+    sock = socket(AF_INET, SOCK_STREAM)
+    sock.setblocking(False)
+    timeout = policy.timeout(key, 'connect')
+    try:
+        started = perf_counter()
+        await wait_for(loop.sock_connect(sock, (result.ip_address, result.port)), timeout)
+        connect_seconds = perf_counter() - started
+    except Exception as e:
+        sock.close()
+        if isinstance(e, TimeoutError):
+            policy.record_timeout(key, 'connect', timeout)
+        raise ConnectError() from e
+    except BaseException:
+        sock.close()
+        raise
+    policy.record(key, 'connect', connect_seconds)
+
+    if result.port != 443:
+        reader, writer = await open_connection(sock=sock)
+        return reader, writer, connect_seconds, None
+
+    try:
+        # The shared context offers the session saved from the last connection to this IP and name, if there is one
+        TLS_TARGET.set((result.ip_address, result.hostname))
+        timeout = policy.timeout(key, 'tls')
+        started = perf_counter()
+        reader, writer = await wait_for(open_connection(
+            sock=sock, ssl=context.tls_sessions.context, server_hostname=result.hostname, ssl_handshake_timeout=timeout
+        ), timeout)
+        tls_seconds = perf_counter() - started
+    except Exception as e:
+        sock.close()
+        if isinstance(e, TimeoutError):
+            policy.record_timeout(key, 'tls', timeout)
+        raise HandshakeError(connect_seconds) from e
+    except BaseException:
+        sock.close()
+        raise
+    policy.record(key, 'tls', tls_seconds)
+    policy.record(key, 'open', connect_seconds + tls_seconds)
+    return reader, writer, connect_seconds, tls_seconds
+
+
+async def _open_hedged(result: ProbeResult, context: ProbeContext, key: str) -> tuple:
+
+    first = create_task(_open(result, context, key))
+    if not context.hedge or (delay := context.policy.hedge_delay(key, 'open')) is None:
+        return await first
+
+    pending = {first}
+    try:
+        done, _ = await wait(pending, timeout=delay)
+        if done:
+            return first.result()
+
+        # The first attempt is slower than this target usually is; race a second one and keep whichever finishes first.
+        # The second attempt is a retry as far as the run's retry budget is concerned
+        if not context.policy.retry_budget.try_retry():
+            return await first
+        pending.add(create_task(_open(result, context, key)))
+        error = None
+        while pending:
+            done, pending = await wait(pending, return_when=FIRST_COMPLETED)
+            winners = [task for task in done if not task.exception()]
+            if winners:
+                for task in winners[1:]:
+                    task.result()[1].close()
+                return winners[0].result()
+            error = [task.exception() for task in done][-1]
+        raise error
+    finally:
+        # Losing attempts, or every attempt if the probe itself was cancelled, aren't left running
+        for task in pending:
+            task.cancel()
+
+
+async def probe(target: str, context: ProbeContext = None) -> ProbeResult:
+
+    result = ProbeResult(target)
+    context = context if context else ProbeContext()
+    key = f"{result.hostname}:{result.port}"
+
+    # Verify hostname resolves in DNS; the connection below uses this address rather than resolving again
+    started = perf_counter()
+    ip_address = await context.resolver.resolve(result.hostname)
+    result.dns_ms = round((perf_counter() - started) * 1000, 1)
+    if not ip_address:
+        return result
+    result.ip_address = ip_address
+    result.is_resolvable = True
+
+    # Names that share a front end share its connection budget
+    if context.ip_budget:
+        async with context.ip_budget.async_semaphore(ip_address):
+            return await _fetch(result, context, key)
+    return await _fetch(result, context, key)
+
+
+async def _fetch(result: ProbeResult, context: ProbeContext, key: str) -> ProbeResult:
+
+    policy = context.policy
+
+    # Verify hostname is reachable on port, and perform the SSL/TLS handshake on the same socket
+    policy.retry_budget.attempt()
+    for attempt in range(RETRIES + 1):
+        try:
+            reader, writer, connect_seconds, tls_seconds = await _open_hedged(result, context, key)
+            break
+        except ConnectError as e:
+            error = e
+        except HandshakeError as e:
+            error = e
+            result.is_reachable = True
+            result.connect_ms = round(e.args[0] * 1000, 1)
+        # Only timeouts are worth another try, and only one per target; a refused connection or a bad cert won't change
+        if attempt == RETRIES or not isinstance(error.__cause__, TimeoutError) or not policy.retry_budget.try_retry():
+            if isinstance(error, HandshakeError):
+                result.tls_info = "ERROR"
+            return result
+
+    result.is_reachable = True
+    result.connect_ms = round(connect_seconds * 1000, 1)
+    try:
+        if tls_seconds is not None:
+            result.tls_ms = round(tls_seconds * 1000, 1)
+            ssl_object = writer.get_extra_info('ssl_object')
+            result.tls_info = ssl_object.version()
+            result.cert_details = ssl_object.getpeercert()
+            result.cert_info = context.cert_cache.get(ssl_object.getpeercert(True), result.cert_details)
+            result.cert_fingerprint = result.cert_info.fingerprint
+            result.calc_ssl_expiration()
+
+        # Send the HTTP request over the existing connection and read the status line
+        try:
+            request = f"GET / HTTP/1.1\r\nHost: {result.hostname}\r\nUser-agent: {USER_AGENT}\r\nConnection: close\r\n\r\n"
+            timeout = policy.timeout(key, 'http')
+            started = perf_counter()
+            writer.write(request.encode())
+            await wait_for(writer.drain(), timeout)
+            status_line = await wait_for(reader.readline(), timeout)
+            ttfb_seconds = perf_counter() - started
+            _, status, reason = (status_line.decode('iso-8859-1').rstrip("\r\n").split(" ", 2) + [""])[:3]
+            result.http_status = str(int(status))
+            if reason:
+                result.http_status += ' ' + reason
+            result.ttfb_ms = round(ttfb_seconds * 1000, 1)
+            policy.record(key, 'http', ttfb_seconds)
+        except TimeoutError:
+            policy.record_timeout(key, 'http', timeout)
+            result.http_status = None
+        except Exception:
+            result.http_status = None
+    finally:
+        # By now any TLS 1.3 session ticket has arrived along with the response
+        if tls_seconds is not None:
+            context.tls_sessions.remember(writer.get_extra_info('ssl_object'))
+        writer.close()
+
+    return result
+
+
+async def _probe_indexed(targets, concurrency: int = CONCURRENCY, context: ProbeContext = None):
+
+    # Workers pull from one shared iterator, so at most 'concurrency' targets are in flight
+    targets = enumerate(iter(targets))
+    results = Queue(maxsize=concurrency)
+    context = context if context else ProbeContext()
+
+    async def worker():
+        for index, target in targets:
+            await results.put((index, await probe(target, context)))
+
+    async def run_workers():
+        try:
+            await gather(*[worker() for _ in range(max(concurrency, 1))])
+        finally:
+            await results.put(None)
+
+    task = create_task(run_workers())
+    while (_ := await results.get()) is not None:
+        yield _
+    await task
+
+
+async def probe_targets(targets, concurrency: int = CONCURRENCY, context: ProbeContext = None):
+
+    # Yields each ProbeResult as soon as its target finishes
+    async for _, result in _probe_indexed(targets, concurrency, context):
+        yield result
+
+
+async def probe_all(targets, concurrency: int = CONCURRENCY, context: ProbeContext = None) -> list:
+
+    # Returns every ProbeResult, in the same order as the input targets
+    results = {}
+    async for index, result in _probe_indexed(targets, concurrency, context):
+        results[index] = result
+    return [results[index] for index in sorted(results)]
+
+
+def iterate(async_iterator):
+
+    # Drives an async iterator (e.g. probe_targets) from synchronous code, one item at a time
+    loop = new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(async_iterator.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(async_iterator.aclose())
+        loop.close()
+
+
+def in_shard(target: str, shard: int, shard_count: int) -> bool:
+
+    # Deterministic across hosts and runs (unlike hash()), so N machines can split one list without coordinating
+    return crc32(target.encode()) % shard_count == shard - 1
+
+
+def _probe_chunk(targets: list, concurrency: int, hedge: bool, history: dict = None, per_ip: int = None) -> tuple:
+
+    # Runs in a worker process, with its own event loop and run-wide state, seeded with the chunk's timeout history.
+    # Hands back what it learned, so the parent can save it
+    policy = TimeoutPolicy()
+    if history:
+        policy.merge(history)
+    context = ProbeContext(policy=policy, hedge=hedge, ip_budget=IPBudget(per_ip) if per_ip else None)
+    return run(probe_all(targets, concurrency, context)), policy.export()
+
+
+def _policy_key(target: str) -> str:
+
+    result = ProbeResult(target)
+    return f"{result.hostname}:{result.port}"
+
+
+def probe_in_processes(targets, workers: int, concurrency: int = CONCURRENCY, hedge: bool = False,
+                       chunk_size: int = CHUNK_SIZE, policy: TimeoutPolicy = None, per_ip: int = None,
+                       addresses: dict = None):
+
+    # Spreads targets across a pool of processes in chunks and yields every ProbeResult, in chunk order.
+    # Only a couple of chunks per worker are read ahead, so memory stays flat however long the list is.
+    # With per_ip, addresses (hostname -> IP) is used to keep each IP's names in one chunk, so the limit holds across processes.
+    # With a policy, each chunk starts from its targets' history and the parent's policy learns what the workers saw.
+    if per_ip:
+        chunks = chunk_by_ip(targets, addresses if addresses else {}, chunk_size)
+    else:
+        targets = iter(targets)
+        chunks = iter(lambda: list(islice(targets, chunk_size)), [])
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        running = {}
+        finished = {}
+        next_index = 0
+        submitted = 0
+        while True:
+            while len(running) < workers * 2 and (chunk := next(chunks, None)):
+                history = policy.export({_policy_key(target) for target in chunk}) if policy else None
+                running[executor.submit(_probe_chunk, chunk, concurrency, hedge, history, per_ip)] = submitted
+                submitted += 1
+            if not running:
+                break
+            done, _ = wait_futures(running, return_when=FUTURES_FIRST_COMPLETED)
+            for future in done:
+                results, history = future.result()
+                if policy:
+                    policy.merge(history)
+                finished[running.pop(future)] = results
+            while next_index in finished:
+                yield from finished.pop(next_index)
+                next_index += 1
+
+
+async def probe_forever(targets, concurrency: int = CONCURRENCY, context: ProbeContext = None, jitter: float = JITTER):
+
+    # Takes (target, interval) pairs and yields each ProbeResult as it finishes, re-probing every target on its own interval
+    loop = get_running_loop()
+    context = context if context else ProbeContext()
+    semaphore = Semaphore(concurrency)
+    results = Queue()
+    wake = Event()
+    running = set()
+
+    # Heap of (due time, sequence, target, interval); the first round is spread across each target's interval
+    heap = []
+    now = loop.time()
+    for seq, (target, interval) in enumerate(targets):
+        heappush(heap, (now + random() * interval, seq, target, interval))
+
+    async def run_one(seq: int, target: str, interval: float):
+        try:
+            result = await probe(target, context)
+        finally:
+            semaphore.release()
+            # Reschedule from completion time, so a slow target never overlaps itself
+            heappush(heap, (loop.time() + interval * uniform(1 - jitter, 1 + jitter), seq, target, interval))
+            wake.set()
+        await results.put(result)
+
+    async def dispatch():
+        while True:
+            delay = heap[0][0] - loop.time() if heap else None
+            if delay is None or delay > 0:
+                try:
+                    await wait_for(wake.wait(), delay)
+                except TimeoutError:
+                    pass
+                wake.clear()
+                continue
+            _, seq, target, interval = heappop(heap)
+            await semaphore.acquire()
+            task = create_task(run_one(seq, target, interval))
+            running.add(task)
+            task.add_done_callback(running.discard)
+
+    dispatcher = create_task(dispatch())
+    try:
+        while True:
+            yield await results.get()
+    finally:
+        dispatcher.cancel()
+        for task in running:
+            task.cancel()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+from array import array
+from atexit import register
+from cProfile import Profile
+from math import ceil
+from sys import stderr
+from tracemalloc import start, stop, take_snapshot, get_traced_memory
+
+PHASES = ["dns_ms", "connect_ms", "tls_ms", "ttfb_ms"]
+PERCENTILES = [50, 95, 99]
+
+
+class PhaseTimings:
+
+    def __init__(self):
+
+        # One flat array of floats per phase keeps memory small even for very long target lists
+        self.samples = {phase: array('d') for phase in PHASES}
+
+    def add(self, target):
+
+        for phase in PHASES:
+            if (value := getattr(target, phase, None)) is not None:
+                self.samples[phase].append(value)
+
+    def percentile(self, phase: str, percent: float):
+
+        if not (values := sorted(self.samples[phase])):
+            return None
+        # Nearest-rank percentile
+        return values[max(ceil(percent / 100 * len(values)) - 1, 0)]
+
+    def summary_rows(self) -> list:
+
+        return [[phase, len(self.samples[phase])] + [self.percentile(phase, p) for p in PERCENTILES] for phase in PHASES]
+
+    def summary_columns(self) -> list:
+
+        return ["Phase", "Count"] + [f"p{p}" for p in PERCENTILES]
+
+
+class RunProfiler:
+
+    def __init__(self, output_prefix: str):
+
+        # Profiles CPU with cProfile and allocations with tracemalloc until stop() or interpreter exit
+        self.output_prefix = output_prefix
+        start()
+        self.profile = Profile()
+        self.profile.enable()
+        register(self.stop)
+
+    def stop(self):
+
+        if not self.profile:
+            return
+        self.profile.disable()
+        self.profile.dump_stats(f"{self.output_prefix}.prof")
+        self.profile = None
+
+        snapshot = take_snapshot()
+        current, peak = get_traced_memory()
+        stop()
+        with open(f"{self.output_prefix}.mem.txt", 'w') as f:
+            f.write(f"current_bytes: {current}\npeak_bytes: {peak}\n")
+            for stat in snapshot.statistics('lineno')[:25]:
+                f.write(f"{stat}\n")
+        print(f"Profile written to {self.output_prefix}.prof and {self.output_prefix}.mem.txt", file=stderr)
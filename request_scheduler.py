@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+from asyncio import Lock, Semaphore, TimeoutError, sleep
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from random import uniform
+from time import monotonic
+from aiohttp import ClientConnectionError, ClientPayloadError, ClientResponseError
+
+# Requests per second for each API, kept under the default per-project read quotas
+RATES = {
+    'compute': 20,
+    'container': 10,
+    'sqladmin': 3,
+    'cloudresourcemanager': 5,
+    'storage': 50,
+}
+DEFAULT_RATE = 10
+MAX_IN_FLIGHT = 50
+RETRIES = 6
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+THROTTLE_STATUSES = (429, 503)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def retry_after(e: ClientResponseError):
+
+    # Retry-After is either a number of seconds or an HTTP date
+    if not (e.headers and (value := e.headers.get('Retry-After'))):
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, burst: float = None):
+
+        self.rate = rate
+        self.burst = burst if burst else max(rate, 1)
+        self.tokens = self.burst
+        self.updated = monotonic()
+        self.paused_until = 0
+        # Waiters are served in order, so one busy collector can't starve the others
+        self.lock = Lock()
+
+    async def acquire(self):
+
+        async with self.lock:
+            while True:
+                now = monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if (wait := self.paused_until - now) <= 0 and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await sleep(max(wait, (1 - self.tokens) / self.rate))
+
+    def pause(self, seconds: float):
+
+        # After a 429 every caller of this API backs off, not only the one that was refused
+        self.paused_until = max(self.paused_until, monotonic() + seconds)
+        self.tokens = 0
+
+
+class APIStats:
+
+    def __init__(self):
+
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.errors = 0
+        self.started = None
+        self.finished = None
+
+    def rate(self) -> float:
+
+        if not (self.started and self.finished and self.finished > self.started):
+            return 0.0
+        return self.requests / (self.finished - self.started)
+
+
+class RequestScheduler:
+
+    def __init__(self, rates: dict = None, max_in_flight: int = MAX_IN_FLIGHT, retries: int = RETRIES):
+
+        self.rates = dict(RATES, **rates) if rates else RATES
+        self.retries = retries
+        self.in_flight = Semaphore(max_in_flight)
+        self.buckets = {}
+        self.stats = {}
+
+    def bucket(self, api_name: str) -> TokenBucket:
+
+        if api_name not in self.buckets:
+            self.buckets[api_name] = TokenBucket(self.rates.get(api_name, DEFAULT_RATE))
+            self.stats[api_name] = APIStats()
+        return self.buckets[api_name]
+
+    async def call(self, api_name: str, request):
+
+        # request is a coroutine function making one HTTP call; retryable failures are retried, the rest raised
+        bucket = self.bucket(api_name)
+        stats = self.stats[api_name]
+        for attempt in range(self.retries + 1):
+            # Wait for a token before taking an in-flight slot, so a slow API doesn't hold slots other APIs could use
+            await bucket.acquire()
+            async with self.in_flight:
+                stats.started = stats.started if stats.started else monotonic()
+                stats.requests += 1
+                try:
+                    result = await request()
+                    stats.finished = monotonic()
+                    return result
+                except ClientResponseError as e:
+                    stats.finished = monotonic()
+                    if e.status not in RETRY_STATUSES or attempt == self.retries:
+                        stats.errors += 1
+                        raise
+                    delay = retry_after(e)
+                    throttled = e.status in THROTTLE_STATUSES
+                    stats.throttled += throttled
+                except (ClientConnectionError, ClientPayloadError, TimeoutError):
+                    stats.finished = monotonic()
+                    if attempt == self.retries:
+                        stats.errors += 1
+                        raise
+                    delay = None
+                    throttled = False
+
+            # Exponential backoff with full jitter, but never sooner than the server asked for
+            backoff = uniform(0, min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX))
+            delay = max(delay, backoff) if delay is not None else backoff
+            if throttled:
+                bucket.pause(delay)
+            stats.retries += 1
+            await sleep(delay)
+
+    def report(self) -> list:
+
+        lines = []
+        for api_name, stats in sorted(self.stats.items()):
+            lines.append(f"{api_name}: {stats.requests} requests, {stats.rate():.1f}/s, {stats.retries} retries, "
+                         f"{stats.throttled} throttled, {stats.errors} errors")
+        return lines
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+from hashlib import sha1
+from json import load, dump
+from os import makedirs, replace
+from os.path import dirname, exists, join
+from time import time
+
+CACHE_DIR = "gcp_cache"
+MAX_AGE = 3600
+
+
+def get_project(url: str) -> str:
+
+    # Calls are filed under the project they list, or "_" for org-wide calls like the project list itself
+    parts = url.split("?")[0].split("/")
+    if "projects" in parts and parts.index("projects") + 1 < len(parts):
+        return parts[parts.index("projects") + 1]
+    return "_"
+
+
+class ResponseCache:
+
+    def __init__(self, cache_dir: str = CACHE_DIR, max_age: float = MAX_AGE):
+
+        # One JSON file per (project, API, call), holding every item of the listing
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.fresh = 0
+        self.revalidated = 0
+        self.fetched = 0
+
+    def path(self, url: str, api_name: str, params: dict) -> str:
+
+        call = url + "?" + "&".join(f"{k}={v}" for k, v in sorted(params.items()))
+        return join(self.cache_dir, get_project(url), f"{api_name}-{sha1(call.encode()).hexdigest()[:16]}.json")
+
+    def get(self, path: str) -> dict:
+
+        if not exists(path):
+            return {}
+        try:
+            with open(path, 'r') as f:
+                return load(f)
+        except Exception:
+            # A damaged entry is just refetched
+            return {}
+
+    def is_fresh(self, entry: dict) -> bool:
+
+        return bool(entry) and time() - entry['fetched'] <= self.max_age
+
+    def put(self, path: str, items: list, etag: str = None, status: int = None):
+
+        # status is set instead of items for calls refused because the API isn't enabled in the project
+        makedirs(dirname(path), exist_ok=True)
+        # Write to a temp file first, so an interrupted run can't leave a truncated entry behind
+        temp_file = f"{path}.tmp"
+        with open(temp_file, 'w') as f:
+            dump({'fetched': time(), 'etag': etag, 'status': status, 'items': items}, f, separators=(',', ':'))
+        replace(temp_file, path)
+
+    def touch(self, path: str, entry: dict):
+
+        # The server confirmed the cached listing is current, so it's good for another max_age
+        self.put(path, entry['items'], entry.get('etag'))
+
+    def report(self) -> str:
+
+        return f"cache: {self.fresh} fresh, {self.revalidated} revalidated, {self.fetched} fetched"
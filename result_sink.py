@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+import csv
+from atexit import register
+from gzip import open as gzip_open
+from os import remove, rename, stat
+from os.path import exists, splitext
+from shutil import copyfileobj
+from threading import Event, Lock, Thread
+from time import time, strftime, localtime
+
+BUFFER_ROWS = 500
+FLUSH_SECONDS = 5.0
+ROTATE_BYTES = 10 * 1024 * 1024
+ROTATE_SECONDS = 86400
+
+
+class ResultSink:
+
+    def __init__(self, csv_file: str, column_names: list = None, buffer_rows: int = BUFFER_ROWS,
+                 flush_seconds: float = FLUSH_SECONDS, rotate_bytes: int = ROTATE_BYTES,
+                 rotate_seconds: float = ROTATE_SECONDS, compress: bool = True):
+
+        self.csv_file = csv_file
+        self.column_names = column_names
+        self.buffer_rows = buffer_rows
+        self.flush_seconds = flush_seconds
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.compress = compress
+
+        # Rows are buffered in memory and written in batches; one lock covers the buffer and the open file
+        self.lock = Lock()
+        self.buffer = []
+        self.fp = None
+        self.writer = None
+        self.opened_at = None
+
+        # Flush on a timer too, so a slow trickle of results still reaches disk
+        self.stopped = Event()
+        self.flusher = Thread(target=self.flush_periodically, daemon=True)
+        self.flusher.start()
+        register(self.close)
+
+    def write(self, row: dict):
+
+        self.write_rows([row])
+
+    def write_rows(self, rows: list):
+
+        with self.lock:
+            self.buffer.extend(rows)
+            if len(self.buffer) < self.buffer_rows:
+                return
+            rotated_file = self.flush_buffer()
+        self.archive(rotated_file)
+
+    def flush(self):
+
+        with self.lock:
+            rotated_file = self.flush_buffer()
+        self.archive(rotated_file)
+
+    def flush_periodically(self):
+
+        while not self.stopped.wait(self.flush_seconds):
+            self.flush()
+
+    def open(self):
+
+        is_new = not exists(self.csv_file) or stat(self.csv_file).st_size == 0
+        self.fp = open(self.csv_file, 'a', newline='')
+        self.writer = csv.writer(self.fp)
+        self.opened_at = self.created_at(is_new)
+        if is_new and self.column_names:
+            self.writer.writerow(self.column_names)
+
+    def created_at(self, is_new: bool) -> float:
+
+        # Every run (e.g. from cron) appends to the same file, so its mtime is always recent; the time it was
+        # started is kept in a marker file beside it instead
+        marker_file = f"{self.csv_file}.created"
+        if not is_new and exists(marker_file):
+            try:
+                with open(marker_file, 'r') as f:
+                    return float(f.read())
+            except (OSError, ValueError):
+                pass
+        # A file from before markers were kept counts from its birth time where the platform has one, otherwise from now
+        created = None if is_new else getattr(stat(self.csv_file), 'st_birthtime', None)
+        created = created if created else time()
+        with open(marker_file, 'w') as f:
+            f.write(str(created))
+        return created
+
+    def flush_buffer(self):
+
+        # Called with the lock held; returns the name of a file that was rotated out, if any
+        if not self.buffer:
+            return None
+
+        if not self.fp:
+            if not self.column_names:
+                self.column_names = list(self.buffer[0].keys())
+            self.open()
+
+        # Checked on the file left by earlier runs too, since a run from cron may only ever flush once
+        rotated_file = None
+        if self.needs_rotation():
+            rotated_file = self.rotate()
+            self.open()
+
+        self.writer.writerows([row.get(column) for column in self.column_names] for row in self.buffer)
+        self.fp.flush()
+        self.buffer.clear()
+        return rotated_file
+
+    def needs_rotation(self) -> bool:
+
+        if self.rotate_bytes and self.fp.tell() >= self.rotate_bytes:
+            return True
+        if self.rotate_seconds and time() - self.opened_at >= self.rotate_seconds:
+            return True
+        return False
+
+    def rotate(self) -> str:
+
+        self.fp.close()
+        self.fp = None
+        base, ext = splitext(self.csv_file)
+        stamp = strftime('%Y%m%d-%H%M%S', localtime())
+        rotated_file = f"{base}.{stamp}{ext}"
+        # Several rotations within a second get a sequence number rather than overwriting each other
+        sequence = 0
+        while exists(rotated_file) or exists(f"{rotated_file}.gz"):
+            sequence += 1
+            rotated_file = f"{base}.{stamp}-{sequence}{ext}"
+        rename(self.csv_file, rotated_file)
+        if exists(marker_file := f"{self.csv_file}.created"):
+            remove(marker_file)
+        return rotated_file
+
+    def archive(self, rotated_file: str):
+
+        # Compression happens outside the lock, so writers aren't held up by it
+        if not (rotated_file and self.compress):
+            return
+        with open(rotated_file, 'rb') as source, gzip_open(f"{rotated_file}.gz", 'wb') as target:
+            copyfileobj(source, target)
+        remove(rotated_file)
+
+    def close(self):
+
+        self.stopped.set()
+        self.flush()
+        with self.lock:
+            if self.fp:
+                self.fp.close()
+                self.fp = None
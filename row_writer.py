@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+from csv import writer as csv_writer
+from json import dumps
+from sys import stdout
+
+FORMATS = ["ndjson", "csv"]
+
+
+class RowWriter:
+
+    def __init__(self, output_format: str, column_names: list, stream=stdout):
+
+        if output_format not in FORMATS:
+            raise ValueError(f"Unhandled output format: '{output_format}'")
+
+        self.output_format = output_format
+        self.column_names = column_names
+        self.stream = stream
+        self.csv_writer = None
+        if output_format == "csv":
+            self.csv_writer = csv_writer(stream)
+            self.csv_writer.writerow(column_names)
+
+    def write(self, row: list):
+
+        if self.csv_writer:
+            self.csv_writer.writerow(row)
+        else:
+            self.stream.write(dumps(dict(zip(self.column_names, row))) + "\n")
+        # Flush every row, so whatever reads the pipe sees results while the scan is still running
+        self.stream.flush()
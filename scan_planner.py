@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+from asyncio import Semaphore as AsyncSemaphore
+from itertools import chain, zip_longest
+from threading import Lock, Semaphore
+
+PER_IP = 2
+
+
+def group_by_ip(targets, addresses: dict) -> dict:
+
+    # addresses maps hostname -> IP (or None); targets may carry a ":port" suffix
+    groups = {}
+    for target in targets:
+        groups.setdefault(addresses.get(target.split(":")[0]), []).append(target)
+    return groups
+
+
+def interleave(groups: dict) -> list:
+
+    # Round-robin across IPs, so a pool of workers spreads over every front end instead of queueing on one
+    return [target for target in chain.from_iterable(zip_longest(*groups.values())) if target is not None]
+
+
+def chunk_by_ip(targets, addresses: dict, chunk_size: int):
+
+    # Packs whole IP groups into chunks of about chunk_size, so every name on an IP lands in the same worker process
+    # and one process's IPBudget covers all connections to that IP
+    chunk = {}
+    size = 0
+    for ip_address, group in group_by_ip(targets, addresses).items():
+        chunk[ip_address] = group
+        size += len(group)
+        if size >= chunk_size:
+            yield interleave(chunk)
+            chunk = {}
+            size = 0
+    if chunk:
+        yield interleave(chunk)
+
+
+def group_certs(results) -> dict:
+
+    # Takes (name, fingerprint) pairs and returns fingerprint -> every name that presented that cert
+    certs = {}
+    for name, fingerprint in results:
+        if fingerprint:
+            certs.setdefault(fingerprint, []).append(name)
+    return certs
+
+
+class IPBudget:
+
+    def __init__(self, per_ip: int = PER_IP):
+
+        # At most per_ip connections in flight to any one IP, however many names point at it
+        self.per_ip = per_ip
+        self.semaphores = {}
+        self.async_semaphores = {}
+        self.lock = Lock()
+
+    def semaphore(self, ip_address: str) -> Semaphore:
+
+        with self.lock:
+            if ip_address not in self.semaphores:
+                self.semaphores[ip_address] = Semaphore(self.per_ip)
+            return self.semaphores[ip_address]
+
+    def async_semaphore(self, ip_address: str) -> AsyncSemaphore:
+
+        if ip_address not in self.async_semaphores:
+            self.async_semaphores[ip_address] = AsyncSemaphore(self.per_ip)
+        return self.async_semaphores[ip_address]
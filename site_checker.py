@@ -1,5 +1,9 @@
 #!/usr/bin/env python3
 
+DAYS_THRESHOLD = 30
+COLUMN_NAMES = ["Target", "IP Address", "TLS info", "HTTP Status", "Notes"]
+
+
 def BuildTable(column_names, rows):
 
     from prettytable import PrettyTable
@@ -12,7 +16,7 @@ def BuildTable(column_names, rows):
 
 class Target:
 
-    def __init__(self, target, port = 443):
+    def __init__(self, target, port = 443, ip_address = None, dns_ms = None, cert_cache = None, timeout_policy = None, resolved = False):
 
         if ":" in target:
             self.hostname, self.port = target.split(":")
@@ -20,8 +24,24 @@ class Target:
             self.hostname = target
             self.port = port
 
+        from timeout_policy import TimeoutPolicy
+
+        self.ip_address = ip_address
+        # Set when ip_address came from an earlier lookup, so None means the name doesn't resolve
+        self.resolved = resolved
+        self.policy = timeout_policy if timeout_policy else TimeoutPolicy()
+        self.cert_cache = cert_cache
+        self.key = f"{self.hostname}:{self.port}"
+
+        # Per-phase timings in milliseconds, None if the phase never ran
+        self.dns_ms = dns_ms
+        self.connect_ms = None
+        self.tls_ms = None
+        self.ttfb_ms = None
+
         self.is_resolvable = False
         self.is_reachable = False        
+        self.sock = None
         self.CheckReachability()
 
         self.tls_info = None
@@ -31,75 +51,123 @@ class Target:
         self.http_status = None
         self.CheckHTTP()
 
+        self.Close()
+
     def CheckReachability(self):
         
-        import socket
+        import socket, time
 
-        # Verify hostname resolves in DNS
-        try:
-            self.ip_address = socket.gethostbyname(self.hostname)
+        # Verify hostname resolves in DNS, unless the caller already resolved it
+        if self.ip_address:
             self.is_resolvable = True
-        except:
-            self.is_resolvable = False
-            self.ip_address = None
-
-        if self.is_resolvable:
-            # Verify hostname is reachable on port
+        elif not self.resolved:
             try:
-                self.sock = socket.create_connection((self.hostname, str(self.port)), timeout=1)
-                self.is_reachable = True
+                started = time.perf_counter()
+                self.ip_address = socket.gethostbyname(self.hostname)
+                self.dns_ms = round((time.perf_counter() - started) * 1000, 1)
+                self.is_resolvable = True
             except:
-                self.is_reachable = False
+                self.is_resolvable = False
+                self.ip_address = None
+
+        if self.is_resolvable:
+            # Verify hostname is reachable on port, connecting to the address resolved above
+            self.policy.retry_budget.attempt()
+            for attempt in range(2):
+                timeout = self.policy.timeout(self.key, 'connect')
+                try:
+                    started = time.perf_counter()
+                    self.sock = socket.create_connection((self.ip_address, str(self.port)), timeout=timeout)
+                    self.connect_ms = round((time.perf_counter() - started) * 1000, 1)
+                    self.policy.record(self.key, 'connect', self.connect_ms / 1000)
+                    self.is_reachable = True
+                    break
+                except socket.timeout:
+                    self.policy.record_timeout(self.key, 'connect', timeout)
+                    # A timeout gets one more try, if the run's retry budget allows it
+                    if attempt or not self.policy.retry_budget.try_retry():
+                        break
+                except:
+                    break
     
     def CheckSSL(self):
 
-        import ssl, time
+        import time
+        from cert_cache import CERT_CACHE
+        from tls_sessions import TLS_SESSIONS
 
+        self.cert_info = None
+        self.cert_fingerprint = None
         if self.is_reachable and self.port == 443:
             # Perform SSL/TLS handshake
             try:
-                self.ssl_context = ssl.create_default_context()
-                ssock = self.ssl_context.wrap_socket(self.sock, server_hostname=self.hostname)
+                # Shared context that resumes the last session with this IP and name; it's saved again when the socket closes
+                self.ssl_context = TLS_SESSIONS.context
+                timeout = self.policy.timeout(self.key, 'tls')
+                self.sock.settimeout(timeout)
+                started = time.perf_counter()
+                self.sock = self.ssl_context.wrap_socket(self.sock, server_hostname=self.hostname)
+                self.tls_ms = round((time.perf_counter() - started) * 1000, 1)
+                self.policy.record(self.key, 'tls', self.tls_ms / 1000)
+                ssock = self.sock
                 self.tls_info = ssock.version()
                 self.cert_details = ssock.getpeercert()
-                self.cert_issued_timestamp = round(time.mktime(time.strptime(self.cert_details['notBefore'], "%b %d %H:%M:%S %Y %Z")))
-                self.cert_expiration_timestamp = round(time.mktime(time.strptime(self.cert_details['notAfter'], "%b %d %H:%M:%S %Y %Z")))
-            except:
+                self.cert_info = (self.cert_cache if self.cert_cache else CERT_CACHE).get(ssock.getpeercert(True), self.cert_details)
+                self.cert_fingerprint = self.cert_info.fingerprint
+            except Exception as e:
+                if isinstance(e, TimeoutError):
+                    self.policy.record_timeout(self.key, 'tls', timeout)
                 self.tls_info = "ERROR"
                 self.cert_details = None
+                self.Close()
         else:
             self.tls_info = None
             self.cert_details = None
         
     def CheckHTTP(self):
 
-        import http.client
+        import http.client, time
     
-        if self.is_reachable:
+        if self.is_reachable and self.sock:
+            timeout = self.policy.timeout(self.key, 'http')
+            if self.port == 443:
+                conn = http.client.HTTPSConnection(self.hostname, self.port, timeout=timeout, context=self.ssl_context)
+            else:
+                conn = http.client.HTTPConnection(self.hostname, self.port, timeout=timeout)
+            # Send the request over the connection already opened (and TLS wrapped) for this target
+            self.sock.settimeout(timeout)
+            conn.sock = self.sock
             try:
-                if self.port == 443:
-                    conn = http.client.HTTPSConnection(self.hostname, self.port, timeout=1, context=self.ssl_context)
-                else:
-                    conn = http.client.HTTPConnection(self.hostname, self.port, timeout=1)
+                started = time.perf_counter()
                 conn.request(method="GET", url="/", headers={'User-agent':"Python http.client"})
                 resp = conn.getresponse()
+                self.ttfb_ms = round((time.perf_counter() - started) * 1000, 1)
+                self.policy.record(self.key, 'http', self.ttfb_ms / 1000)
                 self.http_status = str(resp.status)
                 if resp.reason:
                     self.http_status += ' ' + str(resp.reason)
+            except TimeoutError:
+                self.policy.record_timeout(self.key, 'http', timeout)
+                self.http_status = None
             except:
                 self.http_status = None
-            conn.close()
+    
+    def Close(self):
+
+        if self.sock:
+            self.sock.close()
+            self.sock = None
     
     def CalcSSLExpiration(self):
 
         import time, math
 
-        if self.tls_info and self.cert_details:
+        if self.tls_info and self.cert_info:
 
-            # Get original issue and expriation timestamps
-            self.issued_timestamp = round(time.mktime(time.strptime(self.cert_details['notBefore'], "%b %d %H:%M:%S %Y %Z")))
-            self.expiration_timestamp = round(time.mktime(time.strptime(self.cert_details['notAfter'], "%b %d %H:%M:%S %Y %Z")))
-            self.expiration_datetime = self.cert_details['notAfter']
+            # Get original issue and expriation timestamps, parsed once per distinct cert
+            self.issued_timestamp = self.cert_info.issued_timestamp
+            self.expiration_timestamp = self.cert_info.expiration_timestamp
+            self.expiration_datetime = self.cert_info.not_after
 
             # Adjust for local timezone setting
             local_timezone_offset = time.timezone if (time.localtime().tm_isdst == 0) else time.altzone
@@ -113,87 +181,201 @@ class Target:
             self.issued_timestamp = None
             self.expiration_timestamp = None
 
-def ReadHostnamesList(input_file):
+def IterHostnames(input_file):
 
     import sys
 
-    hostnames = []
-    try:
-        f = open(input_file, 'r')
-    except:
-        sys.exit("Can't open file: '"+ input_file +"'")
+    # Yields hostnames one at a time, so the list never has to be held in memory; '-' reads from stdin
+    if input_file == "-":
+        f = sys.stdin
+    else:
+        try:
+            f = open(input_file, 'r')
+        except:
+            sys.exit("Can't open file: '"+ input_file +"'")
 
     for line in f:
-        if line.startswith('#') or line.startswith('\n'):
+        if line.startswith('#') or not line.strip():
             continue
         else:
-            hostnames.append(line.rstrip())
+            yield line.rstrip()
     f.close()
-    return hostnames
 
-def main():
 
-    import sys, socket, getpass, smtplib
+def ReadHostnamesList(input_file):
+
+    return list(IterHostnames(input_file))
+
+def ParseShard(value):
+
+    import argparse
+
+    # "i/n" means the i-th of n shards, counting from 1
+    try:
+        shard, shard_count = [int(_) for _ in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"shard must look like 'i/n', not '{value}'")
+    if not 1 <= shard <= shard_count:
+        raise argparse.ArgumentTypeError(f"shard index must be between 1 and {shard_count}")
+    return shard, shard_count
+
+
+def GetNotes(target):
+
+    notes = ""
+    if target.tls_info:
+        if target.tls_info == "ERROR":
+            notes += "SSL Handshake failure"
+        else:
+            if target.tls_info != "TLSv1.3" and target.tls_info != "TLSv1.2":
+                notes += "Does not support TLS 1.2 or 1.3"
+    if target.cert_details:
+        if target.days_until_expiration <= DAYS_THRESHOLD:
+            if target.days_until_expiration <= 2:
+                notes += f"Cert expires in {target.hours_until_expiration} hours!!!"
+            else:
+                notes += f"Cert expires in {target.days_until_expiration} days"
+    if target.http_status:
+        if 500 <= int(target.http_status[:3]) < 600:
+             notes += "HTTP 5xx response"
+    return notes
 
-    DAYS_THRESHOLD = 30
 
-    if len(sys.argv) < 2:
-        sys.exit("Usage: " + sys.argv[0] + " 'hostnames_file'")
-    input_file = sys.argv[1]
-    recipient = None
-    if len(sys.argv) > 2:
-        recipient = sys.argv[2]
-    if len(sys.argv) > 3:
-        sender = sys.argv[3]
+def main():
+
+    import sys, socket, getpass, argparse
+
+    parser = argparse.ArgumentParser(usage=sys.argv[0] + " 'hostnames_file' [recipient] [sender]")
+    parser.add_argument("input_file", help="file with one hostname per line, or - to read from stdin")
+    parser.add_argument("recipient", nargs="?")
+    parser.add_argument("sender", nargs="?")
+    parser.add_argument("--concurrency", type=int, default=1, help="number of targets to probe at once (per worker process)")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes to spread the hostname list across")
+    parser.add_argument("--shard", type=ParseShard, metavar="I/N", help="only probe the I-th of N deterministic slices of the list, e.g. 2/4")
+    parser.add_argument("--format", choices=["ndjson", "csv"], help="write each row to stdout as soon as its target finishes")
+    parser.add_argument("--table", action="store_true", help="with --format, also print the summary table (to stderr) at the end")
+    parser.add_argument("--timings", action="store_true", help="print p50/p95/p99 DNS, connect, TLS and time-to-first-byte latencies (to stderr) at the end")
+    parser.add_argument("--profile", metavar="PREFIX", help="write cProfile and tracemalloc data for the run to PREFIX.prof and PREFIX.mem.txt")
+    parser.add_argument("--timeout-history", metavar="FILE", help="file of per-target latencies to learn timeouts from, updated after each run")
+    parser.add_argument("--hedge", action="store_true", help="with --concurrency or --format, start a second connection when a handshake is slower than usual")
+    parser.add_argument("--per-ip", type=int, metavar="N", help="group names by resolved IP, allow at most N connections to each IP at once, and list each cert once (to stderr) with every name it covers")
+    args = parser.parse_args()
+
+    input_file = args.input_file
+    recipient = args.recipient
+    if args.sender:
+        sender = args.sender
     else:
         sender = getpass.getuser() + "@" + socket.getaddrinfo(socket.gethostname(), 0, flags=socket.AI_CANONNAME)[0][3]
 
-    hostnames = ReadHostnamesList(input_file)
+    if args.profile:
+        from probe_stats import RunProfiler
+        RunProfiler(args.profile)
+
+    timings = None
+    if args.timings:
+        from probe_stats import PhaseTimings
+        timings = PhaseTimings()
+
+    # Timeouts are learned from each target's latency history, kept between runs in --timeout-history
+    from timeout_policy import TimeoutPolicy
+    from probe_engine import ProbeContext
+    policy = TimeoutPolicy()
+    if args.timeout_history:
+        policy.load(args.timeout_history)
+    context = ProbeContext(policy=policy, hedge=args.hedge)
+
+    hostnames = IterHostnames(input_file)
+    if args.shard:
+        from probe_engine import in_shard
+        hostnames = (hostname for hostname in hostnames if in_shard(hostname, *args.shard))
+
+    if args.per_ip:
+        # Resolve everything first, then probe round-robin across IPs so no one front end takes the whole burst
+        from dns_cache import resolve_all
+        from scan_planner import IPBudget, group_by_ip, interleave
+        hostnames = list(hostnames)
+        addresses = resolve_all((hostname.split(":")[0] for hostname in hostnames), context.resolver)
+        hostnames = interleave(group_by_ip(hostnames, addresses))
+        context.ip_budget = IPBudget(args.per_ip)
+
+    writer = None
+    if args.format:
+        from row_writer import RowWriter
+        writer = RowWriter(args.format, COLUMN_NAMES)
+
+    if args.workers > 1:
+        # Each worker process runs its own event loop over a slice of the list, seeded with that slice's timeout history;
+        # with --per-ip every name on an IP goes to the same worker, so the limit holds across processes
+        from probe_engine import probe_in_processes
+        targets = probe_in_processes(hostnames, args.workers, concurrency=max(args.concurrency, 1), hedge=args.hedge,
+                                     policy=policy, per_ip=args.per_ip, addresses=addresses if args.per_ip else None)
+    elif args.format:
+        # Read targets lazily and write each row as its target finishes, holding only the rows still needed
+        from probe_engine import iterate, probe_targets
+        targets = iterate(probe_targets(hostnames, concurrency=max(args.concurrency, 1), context=context))
+    elif args.concurrency > 1:
+        # Probe many targets at once, so the run takes as long as the slowest target
+        from asyncio import run
+        from probe_engine import probe_all
+        targets = run(probe_all(hostnames, concurrency=args.concurrency, context=context))
+    else:
+        # Resolve every name up front through the shared cache, then probe one target at a time
+        from dns_cache import resolve_all
+        hostnames = list(hostnames)
+        resolver = context.resolver
+        addresses = resolve_all((hostname.split(":")[0] for hostname in hostnames), resolver)
+        targets = (Target(hostname, ip_address=addresses[hostname.split(":")[0]], dns_ms=resolver.lookup_ms.get(hostname.split(":")[0]), timeout_policy=policy, resolved=True) for hostname in hostnames)
 
     output = ""
     results = []
-    for hostname in hostnames:
-
-        target = Target(hostname)
+    certs = []
+    for target in targets:
         #print(target.hostname, target.port, target.tls_info, target.http_status)
-        notes = ""
-        if target.tls_info:
-            if target.tls_info == "ERROR":
-                notes += "SSL Handshake failure"
-            else:
-                if target.tls_info != "TLSv1.3" and target.tls_info != "TLSv1.2":
-                    notes += "Does not support TLS 1.2 or 1.3"
-        if target.cert_details:
-            if target.days_until_expiration <= DAYS_THRESHOLD:
-                if target.days_until_expiration <= 2:
-                    notes += f"Cert expires in {target.hours_until_expiration} hours!!!"
-                else:
-                    notes += f"Cert expires in {target.days_until_expiration} days"
-        if target.http_status:
-            if 500 <= int(target.http_status[:3]) < 600:
-                 notes += "HTTP 5xx response"
-        results.append([target.hostname + ":" + str(target.port), target.ip_address, target.tls_info, target.http_status, notes])
-
-    output = BuildTable(["Target", "IP Address", "TLS info", "HTTP Status", "Notes"], results)
-
-    if recipient and notes:
-        subject = "Site Issue"
-        message = f"From: {sender}\nTo: {recipient}\nSubject: {subject}\n{output}"
-        try:
-            server = smtplib.SMTP('localhost', port=25)
-            server.ehlo()
-            server.sendmail(sender, recipient, message)
-            server.quit()
-        except Exception as e:
-            print(e)
-    else:
+        notes = GetNotes(target)
+        if timings:
+            timings.add(target)
+        if args.per_ip and target.cert_fingerprint:
+            certs.append((target.hostname + ":" + str(target.port), target.cert_fingerprint, target.expiration_datetime))
+        row = [target.hostname + ":" + str(target.port), target.ip_address, target.tls_info, target.http_status, notes]
+        if writer:
+            writer.write(row)
+        if not writer or args.table or notes:
+            results.append(row)
+
+    output = BuildTable(COLUMN_NAMES, results)
+
+    if args.timeout_history:
+        policy.save(args.timeout_history)
+
+    if recipient and any(row[-1] for row in results):
+        # Same queued, pooled delivery as check_sites; close() sends the batch right away
+        from alert_dispatcher import AlertDispatcher
+        dispatcher = AlertDispatcher(sender, recipient, "Site Issue", render=lambda rows: str(BuildTable(COLUMN_NAMES, rows)))
+        for row in results:
+            dispatcher.alert(row[0], row)
+        dispatcher.close()
+    elif not writer:
         print(output)
 
+    if writer and args.table:
+        print(output, file=sys.stderr)
+
+    if timings:
+        print(BuildTable(timings.summary_columns(), timings.summary_rows()), file=sys.stderr)
+
+    if args.per_ip:
+        from scan_planner import group_certs
+        expires = {fingerprint: expiration for _, fingerprint, expiration in certs}
+        rows = [[fingerprint[:16], expires[fingerprint], len(names), " ".join(names)] for fingerprint, names in group_certs((name, fingerprint) for name, fingerprint, _ in certs).items()]
+        print(BuildTable(["Certificate", "Expires", "Names", "Covers"], rows), file=sys.stderr)
+
 if __name__ == "__main__":
 
+    import sys
     from time import time
 
     start_time: time = time()
     main()
-    print("seconds_to_execute:", round((time() - start_time), 3))
+    print("seconds_to_execute:", round((time() - start_time), 3), file=sys.stderr)
 
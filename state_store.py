@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+from json import load, dump
+from os import replace
+from os.path import exists
+
+STATE_FILE = "check_sites_state.json"
+
+
+class StateStore:
+
+    def __init__(self, state_file: str = STATE_FILE):
+
+        self.state_file = state_file
+        self.records = {}
+        self.is_dirty = False
+
+        if exists(state_file):
+            try:
+                with open(state_file, 'r') as f:
+                    self.records = load(f)
+            except Exception as e:
+                print(f"Ignoring unreadable state file '{state_file}': {e}")
+
+    def get(self, key: str) -> dict:
+
+        return self.records.get(key, {})
+
+    def update(self, key: str, record: dict) -> dict:
+
+        # Stores the latest record for a target and returns the one it replaced
+        previous = self.records.get(key, {})
+        if record != previous:
+            self.records[key] = record
+            self.is_dirty = True
+        return previous
+
+    def known_certs(self) -> dict:
+
+        # Fingerprint -> (issued, expiration) timestamps for every cert seen on a previous run
+        return {r['fingerprint']: (r['issued'], r['expires']) for r in self.records.values() if r.get('fingerprint')}
+
+    def save(self):
+
+        if not self.is_dirty:
+            return
+
+        # Write to a temp file first, so a crash mid-write can't truncate the previous state
+        temp_file = f"{self.state_file}.tmp"
+        with open(temp_file, 'w') as f:
+            dump(self.records, f, separators=(',', ':'))
+        replace(temp_file, self.state_file)
+        self.is_dirty = False
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+from collections import deque
+from json import load, dump
+from math import ceil
+from os import replace
+from os.path import exists
+
+DEFAULT_TIMEOUT = 1.0
+MIN_TIMEOUT = 0.5
+MAX_TIMEOUT = 10.0
+PERCENTILE = 95
+MULTIPLIER = 1.5
+MARGIN = 0.25
+HISTORY_SIZE = 20
+GLOBAL_HISTORY_SIZE = 500
+MIN_SAMPLES = 3
+BACKOFF = 2.0
+RETRY_RATIO = 0.1
+MIN_RETRIES = 5
+
+
+def percentile(values, percent: float):
+
+    values = sorted(values)
+    return values[max(ceil(percent / 100 * len(values)) - 1, 0)]
+
+
+class RetryBudget:
+
+    def __init__(self, ratio: float = RETRY_RATIO, minimum: int = MIN_RETRIES):
+
+        # Retries are capped at a fraction of all attempts in the run, so a dead network can't double the run time
+        self.ratio = ratio
+        self.minimum = minimum
+        self.attempts = 0
+        self.retries = 0
+
+    def attempt(self):
+
+        self.attempts += 1
+
+    def try_retry(self) -> bool:
+
+        if self.retries >= max(self.minimum, self.attempts * self.ratio):
+            return False
+        self.retries += 1
+        return True
+
+
+class TimeoutPolicy:
+
+    def __init__(self, default: float = DEFAULT_TIMEOUT, minimum: float = MIN_TIMEOUT, maximum: float = MAX_TIMEOUT,
+                 retry_budget: RetryBudget = None):
+
+        self.default = default
+        self.minimum = minimum
+        self.maximum = maximum
+        self.retry_budget = retry_budget if retry_budget else RetryBudget()
+        self.history = {}
+        self.global_history = {}
+        self.backoff = {}
+
+    def samples(self, key: str, phase: str, run_wide: bool = False):
+
+        # A target's own history if it has enough of it, otherwise (if run_wide) what the rest of the run has seen for this phase
+        if len(samples := self.history.get((key, phase), ())) >= MIN_SAMPLES:
+            return samples
+        if run_wide and len(samples := self.global_history.get(phase, ())) >= MIN_SAMPLES:
+            return samples
+        return None
+
+    def timeout(self, key: str, phase: str) -> float:
+
+        # Targets without history of their own get the default; a run full of fast hosts says nothing about this one
+        if not (samples := self.samples(key, phase)):
+            timeout = self.default
+        else:
+            timeout = percentile(samples, PERCENTILE) * MULTIPLIER + MARGIN
+        timeout = max(timeout, self.backoff.get((key, phase), 0))
+        return round(min(max(timeout, self.minimum), self.maximum), 3)
+
+    def hedge_delay(self, key: str, phase: str):
+
+        # How long to wait on an attempt before starting a second one in parallel; None until there's history to go on.
+        # The run-wide history is fine here: a hedge only adds an attempt, it never fails one
+        if not (samples := self.samples(key, phase, run_wide=True)):
+            return None
+        return max(percentile(samples, PERCENTILE), 0.05)
+
+    def record(self, key: str, phase: str, seconds: float):
+
+        self.history.setdefault((key, phase), deque(maxlen=HISTORY_SIZE)).append(seconds)
+        self.global_history.setdefault(phase, deque(maxlen=GLOBAL_HISTORY_SIZE)).append(seconds)
+
+    def record_timeout(self, key: str, phase: str, timeout: float):
+
+        # A timeout isn't a latency, so it stays out of the history that's saved between runs; it only doubles
+        # the target's budget for the rest of this run (i.e. its retry), up to the maximum
+        self.backoff[(key, phase)] = min(max(timeout, self.backoff.get((key, phase), 0)) * BACKOFF, self.maximum)
+
+    def load(self, history_file: str):
+
+        if not exists(history_file):
+            return
+        try:
+            with open(history_file, 'r') as f:
+                self.merge(load(f))
+        except Exception as e:
+            print(f"Ignoring unreadable timeout history '{history_file}': {e}")
+
+    def export(self, keys=None) -> dict:
+
+        # The history as {key: {phase: [seconds, ...]}}, optionally only for some targets
+        history = {}
+        for (key, phase), samples in self.history.items():
+            if keys is None or key in keys:
+                history.setdefault(key, {})[phase] = [round(seconds, 4) for seconds in samples]
+        return history
+
+    def merge(self, history: dict):
+
+        # Takes an export() from a file or another process; a target's samples there replace its samples here
+        for key, phases in history.items():
+            for phase, samples in phases.items():
+                self.history[(key, phase)] = deque(samples, maxlen=HISTORY_SIZE)
+                self.global_history.setdefault(phase, deque(maxlen=GLOBAL_HISTORY_SIZE)).extend(samples)
+
+    def save(self, history_file: str):
+
+        history = self.export()
+        temp_file = f"{history_file}.tmp"
+        with open(temp_file, 'w') as f:
+            dump(history, f, separators=(',', ':'))
+        replace(temp_file, history_file)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+from contextvars import ContextVar
+from ssl import SSLContext, SSLSocket, PROTOCOL_TLS_CLIENT, Purpose
+from threading import Lock
+from time import time
+
+MAX_SESSIONS = 10000
+
+# (IP, SNI) of the connection an asyncio task is about to open; wrap_bio() has no socket to read the peer address from
+TLS_TARGET = ContextVar('TLS_TARGET', default=None)
+
+
+class ResumingSocket(SSLSocket):
+
+    def close(self):
+
+        # TLS 1.3 session tickets only arrive after the handshake, so the session is saved when the connection is done
+        if cache := getattr(self.context, 'cache', None):
+            cache.remember(self)
+        super().close()
+
+
+class ResumingContext(SSLContext):
+
+    sslsocket_class = ResumingSocket
+
+    def wrap_socket(self, sock, server_side=False, do_handshake_on_connect=True, suppress_ragged_eofs=True,
+                    server_hostname=None, session=None):
+
+        key = (sock.getpeername()[0], server_hostname)
+        if session is None and self.cache:
+            session = self.cache.get(key)
+        ssock = super().wrap_socket(sock, server_side, do_handshake_on_connect, suppress_ragged_eofs, server_hostname, session)
+        ssock.session_key = key
+        return ssock
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+
+        key = TLS_TARGET.get()
+        if session is None and self.cache and key:
+            session = self.cache.get(key)
+        ssl_object = super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+        ssl_object.session_key = key
+        return ssl_object
+
+
+class TLSSessionCache:
+
+    def __init__(self, max_sessions: int = MAX_SESSIONS):
+
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.lock = Lock()
+        self.handshakes = 0
+        self.resumed = 0
+
+        # One context for the whole run, with the same verification settings as create_default_context()
+        self.context = ResumingContext(PROTOCOL_TLS_CLIENT)
+        self.context.load_default_certs(Purpose.SERVER_AUTH)
+        self.context.cache = self
+
+    def get(self, key: tuple):
+
+        with self.lock:
+            if not (session := self.sessions.get(key)):
+                return None
+            if session.time + session.timeout < time():
+                del self.sessions[key]
+                return None
+            self.sessions.move_to_end(key)
+            return session
+
+    def remember(self, ssl_object, key: tuple = None):
+
+        # Takes an SSLSocket or asyncio's SSLObject, after some data has been read over it
+        key = key if key else getattr(ssl_object, 'session_key', None)
+        try:
+            session = ssl_object.session
+            reused = ssl_object.session_reused
+            is_tls13 = ssl_object.version() == "TLSv1.3"
+        except (ValueError, OSError, AttributeError):
+            return
+        if not (key and session) or getattr(ssl_object, 'session_counted', False):
+            return
+        ssl_object.session_counted = True
+
+        with self.lock:
+            self.handshakes += 1
+            if reused:
+                self.resumed += 1
+            # A TLS 1.3 session without a ticket can't be resumed, and shouldn't replace one that can
+            if is_tls13 and not session.has_ticket:
+                return
+            self.sessions[key] = session
+            self.sessions.move_to_end(key)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+
+# Shared by everything in the process that doesn't bring its own cache
+TLS_SESSIONS = TLSSessionCache()